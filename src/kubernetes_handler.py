@@ -1,21 +1,30 @@
 from kubernetes import client, config
 from loguru import logger
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Callable, Dict, Any, List, Optional, Tuple
 import os
 import re
+import shlex
+import signal
 import subprocess
+import sys
+import time
 from service_handler import ServiceHandler
 from dataclasses import dataclass
 from enum import Enum
+from functools import cached_property
 import asyncio
 import json
+from datetime import datetime, timedelta, timezone
 
 class SecurityMode(Enum):
     """Security modes for command validation"""
     STRICT = "strict"  # Only allow specific commands and parameters
     PERMISSIVE = "permissive"  # Allow any kubectl command with basic safety checks
 
-@dataclass
+# dataclass(slots=True) needs Python 3.10; older interpreters get a regular dataclass
+_DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+@dataclass(**_DATACLASS_SLOTS)
 class CommandResult:
     """Result of a command execution"""
     success: bool
@@ -25,41 +34,71 @@ class CommandResult:
     analysis: Optional[Dict[str, Any]] = None
 
 class KubernetesHandler(ServiceHandler):
+    # Maximum number of validation results kept in the cache
+    VALIDATE_CACHE_SIZE = 4096
+    # Seconds to reuse the API resources returned by the API server
+    API_RESOURCES_TTL = 60.0
+    # (connect, read) timeout in seconds for API calls that stand in for kubectl, so an
+    # unreachable API server falls back to kubectl quickly
+    IN_PROCESS_TIMEOUT = (2, 10)
+    # Default cap on the output kept from a single command (e.g. 'kubectl logs' on a busy pod)
+    MAX_OUTPUT_BYTES = 8 * 1024 * 1024
+    # kubectl subcommands without side effects; chains made only of these may run concurrently
+    READ_ONLY_SUBCOMMANDS = frozenset({"get", "describe", "logs", "top"})
+    # Leading 'NAME=value' words are environment assignments that only a shell applies
+    ENV_ASSIGNMENT_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*=")
+    # Largest batch accepted by handle_commands
+    MAX_BATCH_COMMANDS = 50
+    # Commands from one batch that may run at the same time
+    BATCH_CONCURRENCY = 8
+    # Number of strict validations between re-orderings of the forbidden literals
+    FORBIDDEN_RESORT_INTERVAL = 256
+    # Pod states recognized in command output, in priority order. Each state lists the
+    # (trigger, issue, recommendation) entries reported when the trigger also appears.
+    POD_STATE_TABLE = (
+        ("ContainerCreating", ()),
+        ("Pending", (
+            ("Insufficient", "Insufficient resources", "Check node capacity and resource requests"),
+            ("FailedScheduling", "Scheduling failure", "Check node taints and pod tolerations")
+        )),
+        ("CrashLoopBackOff", (
+            ("Error", "Container error", "Check container logs and configuration"),
+        )),
+        ("ImagePullBackOff", (
+            ("not found", "Image not found", "Verify image name and registry access"),
+            ("unauthorized", "Registry authentication failed", "Check image pull secrets")
+        ))
+    )
+
     def __init__(self, security_mode: SecurityMode = SecurityMode.PERMISSIVE):
-        """Initialize Kubernetes client and security settings"""
-        try:
-            # Try to load in-cluster config first
-            config.load_incluster_config()
-            logger.info("Loaded in-cluster Kubernetes configuration")
-        except config.ConfigException:
-            # Fall back to kubeconfig
-            config.load_kube_config()
-            logger.info("Loaded kubeconfig")
-
-        self.v1 = client.CoreV1Api()
-        self.apps_v1 = client.AppsV1Api()
-        self.batch_v1 = client.BatchV1Api()
+        """Initialize security settings; Kubernetes clients are created on first use"""
+        self._config_loaded = False
+        # Error from the last attempt to load the configuration; it is not retried
+        self._config_error: Optional[Exception] = None
         self.security_mode = security_mode
 
-        # Define allowed commands and their patterns
+        # Define allowed commands keyed by (tool, subcommand); each pattern validates only
+        # the arguments that follow the subcommand
+        allowed_patterns = {
+            # Basic structure: kubectl <command> <resource-type>/<name> [any flags]
+            ("kubectl", "get"): r"^(pods?|deployments?|services?|namespaces?|configmaps?|secrets?|nodes?)(?:\s+[^\s]+)*$",
+            ("kubectl", "describe"): r"^(pod|deployment|service|namespace|configmap|secret|node)\s+[^\s]+(?:\s+[^\s]+)*$",
+            ("kubectl", "create"): r"^(?:[^\s]+\s+)*(deployment|namespace|service)(?:\s+[^\s]+)*$",
+            ("kubectl", "delete"): r"^(pod|deployment|service|namespace)\s+\w+(?:\s+[^\s]+)*$",
+            ("kubectl", "logs"): r"^(?:[^\s]+(?:\s+[^\s]+)*)?$",
+            ("kubectl", "scale"): r"^deployment\s+\w+(?:\s+[^\s]+)*$",
+            ("kubectl", "exec"): r"^(?:[^\s]+\s+)*--\s+\w+.*$",
+            ("kubectl", "config"): r"^(use-context|get-contexts|current-context)(?:\s+[^\s]+)*$",
+            ("helm", "list"): r"^(--all-namespaces|-n\s+\w+)?$",
+            ("helm", "install"): r"^\w+\s+\S+(\s+--namespace\s+\w+|\s+--set\s+\S+)*$",
+            ("helm", "uninstall"): r"^\w+(\s+--namespace\s+\w+)?$",
+            ("helm", "upgrade"): r"^\w+\s+\S+(\s+--namespace\s+\w+|\s+--set\s+\S+)*$"
+        }
+
+        # Compile the allowed patterns once. Commands are lowercased before matching, so the
+        # patterns need no IGNORECASE.
         self.allowed_commands = {
-            "kubectl": {
-                # Basic structure: kubectl <command> <resource-type>/<name> [any flags]
-                "get": r"^kubectl\s+get\s+(pods?|deployments?|services?|namespaces?|configmaps?|secrets?|nodes?)(?:\s+[^\s]+)*$",
-                "describe": r"^kubectl\s+describe\s+(pod|deployment|service|namespace|configmap|secret|node)\s+[^\s]+(?:\s+[^\s]+)*$",
-                "create": r"^kubectl\s+create(?:\s+[^\s]+)*\s+(deployment|namespace|service)(?:\s+[^\s]+)*$",
-                "delete": r"^kubectl\s+delete\s+(pod|deployment|service|namespace)\s+\w+(?:\s+[^\s]+)*$",
-                "logs": r"^kubectl\s+logs(?:\s+[^\s]+)*$",
-                "scale": r"^kubectl\s+scale\s+deployment\s+\w+(?:\s+[^\s]+)*$",
-                "exec": r"^kubectl\s+exec\s+(?:\s+[^\s]+)*\s+--\s+\w+.*$",
-                "config": r"^kubectl\s+config\s+(use-context|get-contexts|current-context)(?:\s+[^\s]+)*$"
-            },
-            "helm": {
-                "list": r"^helm\s+list(\s+--all-namespaces|\s+-n\s+\w+)?$",
-                "install": r"^helm\s+install\s+\w+\s+\S+(\s+--namespace\s+\w+|\s+--set\s+\S+)*$",
-                "uninstall": r"^helm\s+uninstall\s+\w+(\s+--namespace\s+\w+)?$",
-                "upgrade": r"^helm\s+upgrade\s+\w+\s+\S+(\s+--namespace\s+\w+|\s+--set\s+\S+)*$"
-            }
+            key: re.compile(pattern) for key, pattern in allowed_patterns.items()
         }
 
         # Define pod state specific commands
@@ -81,88 +120,466 @@ class KubernetesHandler(ServiceHandler):
             ]
         }
 
-        # Define forbidden patterns (regardless of security mode)
+        # Define forbidden patterns (regardless of security mode). Patterns are searched
+        # anywhere in the command, so they carry no ".*" wrappers.
         self.forbidden_patterns = [
             # General dangerous patterns
-            r".*--privileged.*",
-            r".*--host-network.*",
-            r".*--host-pid.*",
-            r".*--host-ipc.*",
-            r".*--as=root.*",
-            r".*--as=system:admin.*",
-            r".*delete\s+namespace\s+kube-system.*",
-            r".*delete\s+namespace\s+default.*",
+            r"--privileged",
+            r"--host-network",
+            r"--host-pid",
+            r"--host-ipc",
+            r"--as=root",
+            r"--as=system:admin",
+            r"\bdelete\s+namespace\s+kube-system",
+            r"\bdelete\s+namespace\s+default",
 
             # Dangerous API access patterns
-            r".*--raw.*",
-            r".*--v=[4-9].*",
-            r".*--insecure-skip-tls-verify.*",
-            r".*--token=.*",
-            r".*--client-certificate=.*",
-            r".*--client-key=.*",
+            r"--raw",
+            r"--v=[4-9]",
+            r"--insecure-skip-tls-verify",
+            r"--token=",
+            r"--client-certificate=",
+            r"--client-key=",
 
             # Additional dangerous patterns
-            r".*--force.*",
-            r".*--grace-period=0.*",
-            r".*--now.*",
-            r".*--cascade=orphan.*",
-            r".*delete.*--all.*",
-            r".*delete.*--selector=.*",
-            r".*delete.*--field-selector=.*",
-            r".*--all-namespaces.*delete.*",
-            r".*--dry-run=server.*",
-            r".*--server-side.*",
-            r".*--force-conflicts.*",
-            r".*--validate=false.*"
+            r"--force",
+            r"--grace-period=0",
+            r"--now",
+            r"--cascade=orphan",
+            r"\bdelete.*--all",
+            r"\bdelete.*--selector=",
+            r"\bdelete.*--field-selector=",
+            r"--all-namespaces.*\bdelete",
+            r"--dry-run=server",
+            r"--server-side",
+            r"--force-conflicts",
+            r"--validate=false"
         ]
 
-    def _analyze_pod_state(self, output: str) -> Dict[str, Any]:
-        """Analyze pod state from command output"""
-        analysis = {
-            "state": None,
-            "issues": [],
-            "recommendations": []
+        # Most forbidden patterns are plain flags; check those with substring containment
+        # and keep the regex engine for the few structural patterns
+        self._forbidden_literals: Dict[str, str] = {}
+        structural_patterns = []
+        for pattern in self.forbidden_patterns:
+            if any(char in pattern for char in ".^$*+?{}[]\\|()"):
+                structural_patterns.append(pattern)
+            else:
+                self._forbidden_literals[pattern.lower()] = pattern
+
+        # Every literal is a flag, so commands without their common prefix skip the literal scan
+        self._forbidden_literal_prefix = os.path.commonprefix(list(self._forbidden_literals))
+
+        # Hit counts per literal; every FORBIDDEN_RESORT_INTERVAL validations the literals are
+        # re-ordered so the ones that fire most often are checked first
+        self._forbidden_hits: Dict[str, int] = {}
+        self._validations_since_sort = 0
+
+        # Combine the structural patterns into one alternation so a single search covers them all;
+        # named groups map a hit back to its pattern.
+        self._forbidden_names = {f"p{i}": pattern for i, pattern in enumerate(structural_patterns)}
+        self._forbidden_re = re.compile(
+            "|".join(f"(?P<{name}>{pattern})" for name, pattern in self._forbidden_names.items())
+        )
+
+        # Allowed tools for the fast membership check, and the message logged on a denial
+        self._allowed_tools = frozenset(tool for tool, _ in self.allowed_commands)
+        self._denied_tool_msg = f"Allowed tools: {sorted(self._allowed_tools)}"
+
+        # Cache of validation results keyed by (command, security mode)
+        self._validate_cache: Dict[Tuple[str, SecurityMode], bool] = {}
+
+        # Static parts of the service info, plus a TTL cache for the API resources call
+        self._capabilities = {
+            "kubectl": [cmd for tool, cmd in self.allowed_commands if tool == "kubectl"],
+            "helm": [cmd for tool, cmd in self.allowed_commands if tool == "helm"]
         }
+        self._pod_states = list(self.pod_state_commands.keys())
+        self._api_resources_cache = None
+        self._api_resources_ts = 0.0
+
+    def _ensure_config(self):
+        """Load the Kubernetes configuration once, on first use of an API client. Like kubectl,
+        a kubeconfig (KUBECONFIG or ~/.kube/config) wins over the in-cluster service account."""
+        if self._config_loaded:
+            return
+        if self._config_error is not None:
+            raise self._config_error
+        try:
+            if os.environ.get("KUBECONFIG") or os.path.exists(os.path.expanduser("~/.kube/config")):
+                config.load_kube_config()
+                logger.info("Loaded kubeconfig")
+            else:
+                config.load_incluster_config()
+                logger.info("Loaded in-cluster Kubernetes configuration")
+        except Exception as e:
+            self._config_error = e
+            raise
+        self._config_loaded = True
+
+    @cached_property
+    def v1(self) -> client.CoreV1Api:
+        """Core API client"""
+        self._ensure_config()
+        return client.CoreV1Api()
+
+    @cached_property
+    def apps_v1(self) -> client.AppsV1Api:
+        """Apps API client"""
+        self._ensure_config()
+        return client.AppsV1Api()
+
+    @cached_property
+    def batch_v1(self) -> client.BatchV1Api:
+        """Batch API client"""
+        self._ensure_config()
+        return client.BatchV1Api()
+
+    async def _call_client(self, call: Callable[[], Any]) -> Any:
+        """Run a synchronous Kubernetes client call on the default executor. The call is passed
+        as a callable so the lazy config load and client creation also happen off the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, call)
+
+    @classmethod
+    def _split_command(cls, command: str) -> Optional[List[str]]:
+        """Split a command into argv, or return None if it uses shell syntax such as pipes,
+        redirects, substitutions, comments, '~' expansion or leading environment assignments"""
+        if "$" in command or "`" in command:
+            return None
+        try:
+            # A single lexing pass both tokenizes the command and detects shell operators
+            lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+            lexer.whitespace_split = True
+            lexer.commenters = ""
+            argv = list(lexer)
+        except ValueError:
+            # Let the shell report unbalanced quotes
+            return None
+        # Unquoted operators come back as tokens made only of punctuation characters
+        if any(all(char in lexer.punctuation_chars for char in token) for token in argv):
+            return None
+        # Commenters are disabled above so a word starting with '#' is kept; in the shell it
+        # starts a comment, and '~' expands to the home directory
+        if any(token.startswith(("#", "~")) for token in argv):
+            return None
+        if argv and cls.ENV_ASSIGNMENT_RE.match(argv[0]):
+            return None
+        return argv
+
+    def _is_read_only(self, command: str) -> bool:
+        """Whether a command is a plain kubectl read (get, describe, logs, top) without shell syntax"""
+        argv = self._split_command(command)
+        return bool(argv) and len(argv) >= 2 and argv[0] == "kubectl" and argv[1] in self.READ_ONLY_SUBCOMMANDS
+
+    def _merge_get_chain(self, command_parts: List[str]) -> Optional[str]:
+        """Merge a chain like 'kubectl get pods -n x && kubectl get svc -n x' into
+        'kubectl get pods,svc -n x'. Returns None unless every part is a plain 'kubectl get'
+        of a resource type with exactly the same remaining arguments."""
+        if len(command_parts) < 2:
+            return None
+        resources = []
+        shared_args = None
+        for part in command_parts:
+            argv = self._split_command(part)
+            if not argv or len(argv) < 3 or argv[:2] != ["kubectl", "get"]:
+                return None
+            resource = argv[2]
+            # 'type/name' arguments can't be joined with commas
+            if resource.startswith("-") or "/" in resource:
+                return None
+            if shared_args is None:
+                shared_args = argv[3:]
+            elif argv[3:] != shared_args:
+                return None
+            resources.append(resource)
+        return " ".join(["kubectl", "get", ",".join(resources)] + [shlex.quote(arg) for arg in shared_args])
+
+    @staticmethod
+    def _decode(data: bytes) -> str:
+        """Decode subprocess output once, tolerating bytes that are not valid UTF-8"""
+        return data.strip().decode("utf-8", errors="replace")
+
+    async def _spawn(self, command: str) -> asyncio.subprocess.Process:
+        """Start a command, going through a shell only when the command needs one"""
+        argv = self._split_command(command)
+        if argv is None:
+            return await asyncio.create_subprocess_shell(
+                command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True
+            )
+        return await asyncio.create_subprocess_exec(
+            *argv,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True
+        )
+
+    async def _run(self, command: str, max_output_bytes: int) -> Tuple[int, str, str, bool]:
+        """Run a single command and return its exit code, output, error text and whether
+        the output was truncated at max_output_bytes. Only the output is filled in on success
+        and only the error text on failure."""
+        # Simple read-only commands are served by the API client without forking kubectl
+        output = await self._execute_in_process(command)
+        if output is not None:
+            return 0, output, "", False
+
+        process = await self._spawn(command)
+        # Drain stderr concurrently so the process can't block on a full stderr pipe
+        stderr_task = asyncio.ensure_future(process.stderr.read())
+        stdout, truncated = await self._read_capped(process.stdout, max_output_bytes)
+        if truncated:
+            # Stop the process rather than buffering output nobody will read
+            logger.warning("Output of '{}' exceeded {} bytes, truncating", command, max_output_bytes)
+            self._kill(process)
+            # Discard whatever was already in flight so the pipes close and the process is reaped
+            while await process.stdout.read(65536):
+                pass
+            await stderr_task
+            await process.wait()
+            return 0, self._decode(stdout), "", True
+
+        stderr = await stderr_task
+        returncode = await process.wait()
+        # Callers only read the output on success and the error on failure; decode just that one
+        if returncode == 0:
+            return returncode, self._decode(stdout), "", False
+        return returncode, "", self._decode(stderr), False
+
+    @staticmethod
+    def _kill(process: asyncio.subprocess.Process):
+        """Kill a spawned command, including every process of a shell pipeline"""
+        try:
+            if hasattr(os, "killpg"):
+                # _spawn starts each command in its own session, so its pid is the group id
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    async def _read_capped(stream: asyncio.StreamReader, limit: int) -> Tuple[bytes, bool]:
+        """Read a stream in chunks until EOF or until limit bytes have been read"""
+        chunks = []
+        size = 0
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                return b"".join(chunks), False
+            if size + len(chunk) > limit:
+                chunks.append(chunk[:limit - size])
+                return b"".join(chunks), True
+            chunks.append(chunk)
+            size += len(chunk)
+
+    async def _execute_in_process(self, command: str) -> Optional[str]:
+        """Answer 'kubectl get pods' for an explicit namespace (or all namespaces) through the
+        API client, formatted like kubectl's table. Returns None when the command is not
+        covered or the API call fails, so the caller falls back to kubectl."""
+        parts = command.split()
+        if len(parts) < 3 or parts[0] != "kubectl" or parts[1] != "get" or parts[2] not in ("po", "pod", "pods"):
+            return None
+
+        args = parts[3:]
+        if args in (["-A"], ["--all-namespaces"]):
+            namespace = None
+        elif len(args) == 2 and args[0] in ("-n", "--namespace"):
+            namespace = args[1]
+        elif len(args) == 1 and args[0].startswith("--namespace="):
+            namespace = args[0].split("=", 1)[1]
+        else:
+            # Anything else (context default namespace, selectors, output formats) goes to kubectl
+            return None
+
+        if self._config_error is not None:
+            # No configuration to use; kubectl reports the problem
+            return None
+        try:
+            timeout = self.IN_PROCESS_TIMEOUT
+            if namespace is None:
+                pods = await self._call_client(lambda: self.v1.list_pod_for_all_namespaces(_request_timeout=timeout))
+            else:
+                pods = await self._call_client(lambda: self.v1.list_namespaced_pod(namespace, _request_timeout=timeout))
+        except Exception as e:
+            logger.debug("In-process execution failed, falling back to kubectl: {}", e)
+            return None
+
+        now = datetime.now(timezone.utc)
+        header = ["NAME", "READY", "STATUS", "RESTARTS", "AGE"]
+        if namespace is None:
+            header.insert(0, "NAMESPACE")
+        rows = [header] if pods.items else []
+        for pod in pods.items:
+            ready, status, restarts = self._pod_columns(pod, now)
+            row = [
+                pod.metadata.name,
+                ready,
+                status,
+                restarts,
+                self._human_duration(now - pod.metadata.creation_timestamp) if pod.metadata.creation_timestamp else "<unknown>"
+            ]
+            if namespace is None:
+                row.insert(0, pod.metadata.namespace)
+            rows.append(row)
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))] if rows else []
+        return "\n".join("   ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows)
+
+    @classmethod
+    def _pod_columns(cls, pod, now: datetime) -> Tuple[str, str, str]:
+        """Compute the READY, STATUS and RESTARTS columns the way kubectl's pod printer does,
+        including init containers, restartable (sidecar) init containers and the time since
+        the last restart"""
+        status = pod.status
+        init_specs = {c.name: c for c in pod.spec.init_containers or []}
+        total = len(pod.spec.containers) + sum(1 for c in init_specs.values() if cls._is_sidecar(c))
+        ready = 0
+        restarts = 0
+        sidecar_restarts = 0
+        last_restart = None
+        last_sidecar_restart = None
+
+        reason = status.reason or status.phase or "Unknown"
+        for condition in status.conditions or []:
+            if condition.type == "PodScheduled" and condition.reason == "SchedulingGated":
+                reason = "SchedulingGated"
+
+        initializing = False
+        init_statuses = status.init_container_statuses or []
+        for i, cs in enumerate(init_statuses):
+            sidecar = cls._is_sidecar(init_specs.get(cs.name))
+            finished = cls._last_termination(cs)
+            restarts += cs.restart_count
+            last_restart = cls._latest(last_restart, finished)
+            if sidecar:
+                sidecar_restarts += cs.restart_count
+                last_sidecar_restart = cls._latest(last_sidecar_restart, finished)
+
+            terminated = cs.state.terminated if cs.state else None
+            waiting = cs.state.waiting if cs.state else None
+            if terminated and terminated.exit_code == 0:
+                continue
+            if sidecar and cs.started:
+                if cs.ready:
+                    ready += 1
+                continue
+            if terminated:
+                # Initialization failed
+                if terminated.reason:
+                    reason = f"Init:{terminated.reason}"
+                elif terminated.signal:
+                    reason = f"Init:Signal:{terminated.signal}"
+                else:
+                    reason = f"Init:ExitCode:{terminated.exit_code}"
+            elif waiting and waiting.reason and waiting.reason != "PodInitializing":
+                reason = f"Init:{waiting.reason}"
+            else:
+                reason = f"Init:{i}/{len(init_specs)}"
+            initializing = True
+            break
+
+        initialized = any(c.type == "Initialized" and c.status == "True" for c in status.conditions or [])
+        if not initializing or initialized:
+            restarts = sidecar_restarts
+            last_restart = last_sidecar_restart
+            has_running = False
+            for cs in reversed(status.container_statuses or []):
+                restarts += cs.restart_count
+                last_restart = cls._latest(last_restart, cls._last_termination(cs))
+                waiting = cs.state.waiting if cs.state else None
+                terminated = cs.state.terminated if cs.state else None
+                if waiting and waiting.reason:
+                    reason = waiting.reason
+                elif terminated and terminated.reason:
+                    reason = terminated.reason
+                elif terminated:
+                    reason = f"Signal:{terminated.signal}" if terminated.signal else f"ExitCode:{terminated.exit_code}"
+                elif cs.ready and cs.state and cs.state.running:
+                    has_running = True
+                    ready += 1
+            # A completed pod with a container still running is reported as running again
+            if reason == "Completed" and has_running:
+                pod_ready = any(c.type == "Ready" and c.status == "True" for c in status.conditions or [])
+                reason = "Running" if pod_ready else "NotReady"
+
+        if pod.metadata.deletion_timestamp:
+            if status.reason == "NodeLost":
+                reason = "Unknown"
+            elif status.phase not in ("Succeeded", "Failed"):
+                reason = "Terminating"
+
+        restarts_column = str(restarts)
+        if restarts and last_restart:
+            restarts_column = f"{restarts} ({cls._human_duration(now - last_restart)} ago)"
+        return f"{ready}/{total}", reason, restarts_column
+
+    @staticmethod
+    def _is_sidecar(container) -> bool:
+        """Whether an init container is restartable, i.e. a sidecar that keeps running"""
+        return container is not None and getattr(container, "restart_policy", None) == "Always"
+
+    @staticmethod
+    def _last_termination(container_status) -> Optional[datetime]:
+        """When the container's previous run finished, if it restarted"""
+        last_state = container_status.last_state
+        if last_state and last_state.terminated:
+            return last_state.terminated.finished_at
+        return None
+
+    @staticmethod
+    def _latest(current: Optional[datetime], candidate: Optional[datetime]) -> Optional[datetime]:
+        """The later of two optional timestamps"""
+        if candidate is None:
+            return current
+        if current is None or candidate > current:
+            return candidate
+        return current
+
+    @staticmethod
+    def _human_duration(delta: timedelta) -> str:
+        """Format an age like kubectl (e.g. 45s, 5m30s, 3h12m, 4d2h)"""
+        seconds = max(int(delta.total_seconds()), 0)
+        minutes, hours, days = seconds // 60, seconds // 3600, seconds // 86400
+        if seconds < 120:
+            return f"{seconds}s"
+        if minutes < 10:
+            return f"{minutes}m{seconds % 60}s" if seconds % 60 else f"{minutes}m"
+        if minutes < 180:
+            return f"{minutes}m"
+        if hours < 8:
+            return f"{hours}h{minutes % 60}m" if minutes % 60 else f"{hours}h"
+        if hours < 48:
+            return f"{hours}h"
+        if hours < 192:
+            return f"{days}d{hours % 24}h" if hours % 24 else f"{days}d"
+        if days < 730:
+            return f"{days}d"
+        years = days // 365
+        if years < 8:
+            return f"{years}y{days % 365}d" if days % 365 else f"{years}y"
+        return f"{years}y"
+
+    async def execute_command(self, command: str, max_output_bytes: Optional[int] = None) -> Dict[str, Any]:
+        """Execute a kubectl command and return the result. Output beyond max_output_bytes
+        (default MAX_OUTPUT_BYTES) is dropped and the result is marked as truncated. Parts of
+        a chained command run concurrently when all of them are read-only kubectl commands,
+        otherwise in order."""
+        # Validate the command first
+        if not await self.validate_command(command):
+            return {
+                "success": False,
+                "error": "Invalid command"
+            }
 
-        # Check for Pending state
-        if "Pending" in output:
-            analysis["state"] = "Pending"
-            if "Insufficient" in output:
-                analysis["issues"].append("Insufficient resources")
-                analysis["recommendations"].append("Check node capacity and resource requests")
-            if "FailedScheduling" in output:
-                analysis["issues"].append("Scheduling failure")
-                analysis["recommendations"].append("Check node taints and pod tolerations")
-
-        # Check for CrashLoopBackOff
-        elif "CrashLoopBackOff" in output:
-            analysis["state"] = "CrashLoopBackOff"
-            if "Error" in output:
-                analysis["issues"].append("Container error")
-                analysis["recommendations"].append("Check container logs and configuration")
-
-        # Check for ImagePullBackOff
-        elif "ImagePullBackOff" in output:
-            analysis["state"] = "ImagePullBackOff"
-            if "not found" in output:
-                analysis["issues"].append("Image not found")
-                analysis["recommendations"].append("Verify image name and registry access")
-            if "unauthorized" in output:
-                analysis["issues"].append("Registry authentication failed")
-                analysis["recommendations"].append("Check image pull secrets")
-
-        return analysis
+        return await self._execute_prevalidated(command, max_output_bytes)
 
-    async def execute_command(self, command: str) -> Dict[str, Any]:
-        """Execute a kubectl command and return the result"""
+    async def _execute_prevalidated(self, command: str, max_output_bytes: Optional[int] = None) -> Dict[str, Any]:
+        """Execute a command that has already passed validate_command"""
+        if max_output_bytes is None:
+            max_output_bytes = self.MAX_OUTPUT_BYTES
         try:
-            # Validate the command first
-            if not await self.validate_command(command):
-                return {
-                    "success": False,
-                    "error": "Invalid command"
-                }
-
             # Check if this is a chained command
             if "&&" in command:
                 # Split the command into parts
@@ -176,23 +593,43 @@ class KubernetesHandler(ServiceHandler):
                 }
                 any_success = False
 
-                # Execute each part separately
-                for part in command_parts:
-                    logger.info(f"Executing command part: {part}")
-                    process = await asyncio.create_subprocess_shell(
-                        part,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE
-                    )
-                    stdout, stderr = await process.communicate()
-
-                    if process.returncode == 0:
-                        output = stdout.decode().strip()
+                async def run_part(part: str) -> Tuple[int, str, str, bool, Dict[str, Any]]:
+                    """Execute one part of the chain and analyze its output"""
+                    logger.info("Executing command part: {}", part)
+                    returncode, output, error, truncated = await self._run(part, max_output_bytes)
+                    if returncode != 0:
+                        return returncode, "", error, False, {}
+                    part_analysis = self._analyze_output(output)
+                    if part_analysis["state"] == "ContainerCreating":
+                        part_analysis = await self._analyze_container_creating(part, part_analysis)
+                    return 0, output, "", truncated, part_analysis
+
+                # 'kubectl get' parts sharing the same flags collapse into one invocation;
+                # if that fails (e.g. one unknown type) run the parts individually
+                merged_command = self._merge_get_chain(command_parts)
+                merged_result = None
+                if merged_command:
+                    logger.info("Executing merged command: {}", merged_command)
+                    merged_result = await run_part(merged_command)
+
+                if merged_result is not None and merged_result[0] == 0:
+                    command_parts = [merged_command]
+                    part_results = [merged_result]
+                # A later part may depend on an earlier part's side effects (create a namespace,
+                # then a deployment in it), so only chains of read-only parts run concurrently
+                elif not all(self._is_read_only(part) for part in command_parts):
+                    part_results = [await run_part(part) for part in command_parts]
+                else:
+                    part_results = await asyncio.gather(*(run_part(part) for part in command_parts))
+
+                # Merge the results in the order the parts were given
+                any_truncated = False
+                for part, (returncode, output, error, truncated, part_analysis) in zip(command_parts, part_results):
+                    any_truncated = any_truncated or truncated
+                    if returncode == 0:
                         if output:  # Only add non-empty output
                             combined_output.append(f"=== Output from: {part} ===\n{output}")
                         any_success = True
-                        # Analyze this part's output
-                        part_analysis = await self._analyze_pod_state(part, output)
                         # Merge analysis results
                         if part_analysis["state"]:
                             combined_analysis["state"] = part_analysis["state"]
@@ -201,7 +638,6 @@ class KubernetesHandler(ServiceHandler):
                         if "details" in part_analysis:
                             combined_analysis["details"] = part_analysis["details"]
                     else:
-                        error = stderr.decode().strip()
                         if error:  # Only add non-empty errors
                             combined_output.append(f"=== Error from: {part} ===\n{error}")
                         logger.warning(f"Command part failed: {error}")
@@ -220,35 +656,33 @@ class KubernetesHandler(ServiceHandler):
                     "success": any_success,  # Consider it a success if any part succeeded
                     "raw_output": final_output,
                     "output": final_output,
+                    "truncated": any_truncated,
                     "analysis": combined_analysis
                 }
 
             else:
                 # Execute single command
-                logger.info(f"Executing command: {command}")
-                process = await asyncio.create_subprocess_shell(
-                    command,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                stdout, stderr = await process.communicate()
+                # Pass arguments to loguru so nothing is formatted when the level is disabled
+                logger.info("Executing command: {}", command)
+                returncode, output, error, truncated = await self._run(command, max_output_bytes)
 
                 # Check if the command was successful
-                if process.returncode == 0:
-                    output = stdout.decode().strip()
-                    logger.info(f"Command executed successfully. Output: {output}")
+                if returncode == 0:
+                    logger.debug("Command executed successfully. Output: {}", output)
 
                     # Analyze the output for pod states
-                    analysis = await self._analyze_pod_state(output)
+                    analysis = self._analyze_output(output)
+                    if analysis["state"] == "ContainerCreating":
+                        analysis = await self._analyze_container_creating(command, analysis)
 
                     return {
                         "success": True,
                         "raw_output": output,
                         "output": output,
+                        "truncated": truncated,
                         "analysis": analysis
                     }
                 else:
-                    error = stderr.decode().strip()
                     logger.error(f"Command failed: {error}")
                     return {
                         "success": False,
@@ -270,16 +704,18 @@ class KubernetesHandler(ServiceHandler):
     async def get_service_info(self) -> Dict[str, Any]:
         """Get information about the Kubernetes service"""
         try:
-            version = self.v1.get_api_resources()
+            # API resources rarely change, so only refresh them once the TTL has expired
+            now = time.monotonic()
+            if self._api_resources_cache is None or now - self._api_resources_ts >= self.API_RESOURCES_TTL:
+                self._api_resources_cache = await self._call_client(lambda: self.v1.get_api_resources())
+                self._api_resources_ts = now
+
             return {
                 "name": "kubernetes",
-                "version": version,
+                "version": self._api_resources_cache,
                 "security_mode": self.security_mode.value,
-                "capabilities": {
-                    "kubectl": list(self.allowed_commands["kubectl"].keys()),
-                    "helm": list(self.allowed_commands["helm"].keys())
-                },
-                "pod_states": list(self.pod_state_commands.keys())
+                "capabilities": self._capabilities,
+                "pod_states": self._pod_states
             }
         except Exception as e:
             logger.error(f"Error getting Kubernetes service info: {str(e)}")
@@ -288,7 +724,10 @@ class KubernetesHandler(ServiceHandler):
     async def handle_command(self, command: str, parameters: Dict[str, Any]) -> Dict[str, Any]:
         """Handle a command by executing it directly"""
         try:
-            result = await self.execute_command(command)
+            if not await self.validate_command(command):
+                raise ValueError("Command failed: Invalid command")
+
+            result = await self._execute_prevalidated(command)
             if not result["success"]:
                 raise ValueError(f"Command failed: {result['error']}")
 
@@ -303,24 +742,90 @@ class KubernetesHandler(ServiceHandler):
             logger.error(f"Error handling command {command}: {str(e)}")
             raise
 
+    async def handle_commands(self, commands: List[str]) -> List[Dict[str, Any]]:
+        """Validate a batch of commands up front, then execute them; batches of read-only
+        commands run concurrently (bounded), any other batch runs in order"""
+        if len(commands) > self.MAX_BATCH_COMMANDS:
+            raise ValueError(f"Too many commands: {len(commands)} (limit {self.MAX_BATCH_COMMANDS})")
+        for command in commands:
+            if not await self.validate_command(command):
+                raise ValueError(f"Invalid command: {command}")
+
+        # As with chains, a command may depend on an earlier command's side effects
+        if not all(self._is_read_only(command) for command in commands):
+            results = [await self._execute_prevalidated(command) for command in commands]
+        else:
+            semaphore = asyncio.Semaphore(self.BATCH_CONCURRENCY)
+
+            async def run(command: str) -> Dict[str, Any]:
+                async with semaphore:
+                    return await self._execute_prevalidated(command)
+
+            results = await asyncio.gather(*(run(command) for command in commands))
+        return [{"command": command, **result} for command, result in zip(commands, results)]
+
     async def validate_command(self, command: str) -> bool:
         """Validate if a command can be handled by this service"""
+        # Validation is pure with respect to the command and security mode, so memoize it
+        key = (command, self.security_mode)
+        cached = self._validate_cache.get(key)
+        if cached is not None:
+            return cached
+
+        result = self._validate_command(command)
+        if len(self._validate_cache) >= self.VALIDATE_CACHE_SIZE:
+            # Evict the oldest entry
+            self._validate_cache.pop(next(iter(self._validate_cache)))
+        self._validate_cache[key] = result
+        return result
+
+    def _resort_forbidden_literals(self):
+        """Move the most frequently hit forbidden literals to the front of the check order"""
+        self._forbidden_literals = dict(sorted(
+            self._forbidden_literals.items(),
+            key=lambda item: -self._forbidden_hits.get(item[0], 0)
+        ))
+        self._validations_since_sort = 0
+
+    def _validate_command(self, command: str) -> bool:
+        """Run the forbidden and allowed pattern checks against a command"""
         try:
             # Skip validation in permissive mode
             if self.security_mode == SecurityMode.PERMISSIVE:
                 return True
 
-            # Check forbidden patterns first
-            for pattern in self.forbidden_patterns:
-                if re.match(pattern, command, re.IGNORECASE):
-                    logger.warning(f"Command matches forbidden pattern: {pattern}")
-                    return False
+            # Lowercase once; every check below matches against the lowercased command
+            lowered = command.lower()
 
-            # Check allowed commands
-            for tool, commands in self.allowed_commands.items():
-                for cmd, pattern in commands.items():
-                    if re.match(pattern, command, re.IGNORECASE):
-                        return True
+            # Check forbidden patterns first
+            self._validations_since_sort += 1
+            if self._validations_since_sort >= self.FORBIDDEN_RESORT_INTERVAL:
+                self._resort_forbidden_literals()
+
+            # No literal can match unless their shared prefix ("--") appears in the command
+            if self._forbidden_literal_prefix in lowered:
+                for literal, pattern in self._forbidden_literals.items():
+                    if literal in lowered:
+                        self._forbidden_hits[literal] = self._forbidden_hits.get(literal, 0) + 1
+                        logger.warning(f"Command matches forbidden pattern: {pattern}")
+                        return False
+
+            match = self._forbidden_re.search(lowered)
+            if match:
+                logger.warning(f"Command matches forbidden pattern: {self._forbidden_names[match.lastgroup]}")
+                return False
+
+            # Reject unknown tools, splitting on any whitespace as the shell does
+            parts = lowered.split()
+            if not parts or parts[0] not in self._allowed_tools:
+                logger.warning(f"Command uses a tool that is not allowed. {self._denied_tool_msg}")
+                return False
+
+            # Look up the (tool, subcommand) pattern and match only the arguments against it
+            if len(parts) >= 2:
+                pattern = self.allowed_commands.get((parts[0], parts[1]))
+                if pattern and pattern.match(" ".join(parts[2:])):
+                    return True
 
             logger.warning(f"Command not in allowed patterns: {command}")
             return False
@@ -329,124 +834,111 @@ class KubernetesHandler(ServiceHandler):
             logger.error(f"Error validating command: {str(e)}")
             return False
 
-    async def _analyze_pod_state(self, command: str, output: str = "") -> Dict[str, Any]:
-        """Analyze pod state from command output"""
-        try:
-            analysis = {
-                "state": None,
-                "issues": [],
-                "recommendations": []
-            }
+    def _analyze_output(self, output: str) -> Dict[str, Any]:
+        """Analyze pod state from command output with a plain string scan"""
+        analysis = {
+            "state": None,
+            "issues": [],
+            "recommendations": []
+        }
 
-            # If no output provided, return empty analysis
-            if not output:
-                return analysis
-
-            # Check for ContainerCreating state
-            if "ContainerCreating" in output:
-                analysis["state"] = "ContainerCreating"
-                pod_name = None
-                namespace = None
-
-                # Extract pod name and namespace from the command
-                if "describe pods" in command:
-                    # Extract namespace from -n flag
-                    if "-n" in command:
-                        namespace = command.split("-n")[1].split()[0].strip()
-                    # Extract pod name from the command
-                    if "-l" in command:
-                        # If using label selector, we need to get pod names
-                        pod_list_cmd = f"kubectl get pods -n {namespace} -l app=nr-ebpf-agent -o jsonpath='{{.items[*].metadata.name}}'"
-                        pod_names = await self.execute_command(pod_list_cmd)
-                        if pod_names.success:
-                            pod_name = pod_names.output.split()[0]  # Get first pod
-                    else:
-                        # Extract pod name directly
-                        pod_name = command.split("describe pods")[1].strip().split()[0]
-
-                if pod_name and namespace:
-                    # Get detailed pod information
-                    describe_cmd = f"kubectl describe pod {pod_name} -n {namespace}"
-                    describe_output = await self.execute_command(describe_cmd)
-
-                    # Get events for the namespace
-                    events_cmd = f"kubectl get events -n {namespace} --sort-by='.lastTimestamp'"
-                    events_output = await self.execute_command(events_cmd)
-
-                    # Check for common ContainerCreating issues
-                    if "ImagePullBackOff" in describe_output.output:
-                        analysis["issues"].append("Container image pull failed")
-                        analysis["recommendations"].extend([
-                            "Check if the image exists in the registry",
-                            "Verify image pull secrets are configured correctly",
-                            "Check network connectivity to the container registry"
-                        ])
-
-                    if "FailedScheduling" in events_output.output:
-                        analysis["issues"].append("Pod scheduling failed")
-                        analysis["recommendations"].extend([
-                            "Check node resource availability",
-                            "Verify node selectors and affinity rules",
-                            "Check for taints and tolerations"
-                        ])
-
-                    if "FailedMount" in describe_output.output:
-                        analysis["issues"].append("Volume mount failed")
-                        analysis["recommendations"].extend([
-                            "Check if the volume exists",
-                            "Verify volume mount permissions",
-                            "Check for storage class issues"
-                        ])
-
-                    if "CrashLoopBackOff" in describe_output.output:
-                        analysis["issues"].append("Container is crashing")
-                        analysis["recommendations"].extend([
-                            "Check container logs for errors",
-                            "Verify container configuration",
-                            "Check resource limits and requests"
-                        ])
-
-                    if not analysis["issues"]:
-                        analysis["issues"].append("Container is still being created")
-                        analysis["recommendations"].extend([
-                            "Check pod events for more details",
-                            "Verify container image and registry access",
-                            "Check for resource constraints"
-                        ])
-
-                    analysis["details"] = {
-                        "pod_name": pod_name,
-                        "namespace": namespace,
-                        "events": events_output.output if events_output.success else "Could not fetch events",
-                        "pod_details": describe_output.output if describe_output.success else "Could not fetch pod details"
-                    }
+        # If no output provided, return empty analysis
+        if not output:
+            return analysis
 
-            # Check for Pending state
-            elif "Pending" in output:
-                analysis["state"] = "Pending"
-                if "Insufficient" in output:
-                    analysis["issues"].append("Insufficient resources")
-                    analysis["recommendations"].append("Check node capacity and resource requests")
-                if "FailedScheduling" in output:
-                    analysis["issues"].append("Scheduling failure")
-                    analysis["recommendations"].append("Check node taints and pod tolerations")
-
-            # Check for CrashLoopBackOff
-            elif "CrashLoopBackOff" in output:
-                analysis["state"] = "CrashLoopBackOff"
-                if "Error" in output:
-                    analysis["issues"].append("Container error")
-                    analysis["recommendations"].append("Check container logs and configuration")
-
-            # Check for ImagePullBackOff
-            elif "ImagePullBackOff" in output:
-                analysis["state"] = "ImagePullBackOff"
-                if "not found" in output:
-                    analysis["issues"].append("Image not found")
-                    analysis["recommendations"].append("Verify image name and registry access")
-                if "unauthorized" in output:
-                    analysis["issues"].append("Registry authentication failed")
-                    analysis["recommendations"].append("Check image pull secrets")
+        # The first state found wins; ContainerCreating details come from _analyze_container_creating
+        for state, triggers in self.POD_STATE_TABLE:
+            if state in output:
+                analysis["state"] = state
+                for trigger, issue, recommendation in triggers:
+                    if trigger in output:
+                        analysis["issues"].append(issue)
+                        analysis["recommendations"].append(recommendation)
+                break
+
+        return analysis
+
+    async def _analyze_container_creating(self, command: str, analysis: Dict[str, Any]) -> Dict[str, Any]:
+        """Add diagnostics for pods stuck in ContainerCreating by describing the pod and
+        fetching namespace events"""
+        try:
+            pod_name = None
+            namespace = None
+
+            # Extract pod name and namespace from the command
+            if "describe pods" in command:
+                # Extract namespace from -n flag
+                if "-n" in command:
+                    namespace = command.split("-n")[1].split()[0].strip()
+                # Extract pod name from the command
+                if "-l" in command:
+                    # If using label selector, we need to get pod names
+                    pod_list_cmd = f"kubectl get pods -n {namespace} -l app=nr-ebpf-agent -o jsonpath='{{.items[*].metadata.name}}'"
+                    pod_names = await self.execute_command(pod_list_cmd)
+                    if pod_names["success"] and pod_names["output"]:
+                        pod_name = pod_names["output"].split()[0]  # Get first pod
+                else:
+                    # Extract pod name directly
+                    pod_name = command.split("describe pods")[1].strip().split()[0]
+
+            if pod_name and namespace:
+                # Get detailed pod information and the namespace events concurrently
+                describe_cmd = f"kubectl describe pod {pod_name} -n {namespace}"
+                events_cmd = f"kubectl get events -n {namespace} --sort-by='.lastTimestamp'"
+                describe_result, events_result = await asyncio.gather(
+                    self.execute_command(describe_cmd),
+                    self.execute_command(events_cmd)
+                )
+                describe_output = describe_result.get("output", "")
+                events_output = events_result.get("output", "")
+
+                # Check for common ContainerCreating issues
+                if "ImagePullBackOff" in describe_output:
+                    analysis["issues"].append("Container image pull failed")
+                    analysis["recommendations"].extend([
+                        "Check if the image exists in the registry",
+                        "Verify image pull secrets are configured correctly",
+                        "Check network connectivity to the container registry"
+                    ])
+
+                if "FailedScheduling" in events_output:
+                    analysis["issues"].append("Pod scheduling failed")
+                    analysis["recommendations"].extend([
+                        "Check node resource availability",
+                        "Verify node selectors and affinity rules",
+                        "Check for taints and tolerations"
+                    ])
+
+                if "FailedMount" in describe_output:
+                    analysis["issues"].append("Volume mount failed")
+                    analysis["recommendations"].extend([
+                        "Check if the volume exists",
+                        "Verify volume mount permissions",
+                        "Check for storage class issues"
+                    ])
+
+                if "CrashLoopBackOff" in describe_output:
+                    analysis["issues"].append("Container is crashing")
+                    analysis["recommendations"].extend([
+                        "Check container logs for errors",
+                        "Verify container configuration",
+                        "Check resource limits and requests"
+                    ])
+
+                if not analysis["issues"]:
+                    analysis["issues"].append("Container is still being created")
+                    analysis["recommendations"].extend([
+                        "Check pod events for more details",
+                        "Verify container image and registry access",
+                        "Check for resource constraints"
+                    ])
+
+                analysis["details"] = {
+                    "pod_name": pod_name,
+                    "namespace": namespace,
+                    "events": events_output if events_result["success"] else "Could not fetch events",
+                    "pod_details": describe_output if describe_result["success"] else "Could not fetch pod details"
+                }
 
             return analysis
 
@@ -1,17 +1,61 @@
-from typing import Dict, Any, List, Optional
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Any, Optional
+from collections import OrderedDict, deque
 from loguru import logger
+import asyncio
 import boto3
+import hashlib
 import json
 import os
+import threading
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from service_handler import ServiceHandler
 from dataclasses import dataclass
 from datetime import datetime
 
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:  # orjson is optional, fall back to the standard library
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+    _json_loads = json.loads
+
+# Prompt template read from PROMPT.md, shared by every handler instance
+_PROMPT_CACHE: Optional[str] = None
+
+# bedrock-runtime clients keyed by region, shared by every handler instance so their
+# pooled keep-alive connections are reused across requests
+_BEDROCK_CLIENTS: Dict[str, Any] = {}
+
+def _bedrock_client(region: str, max_connections: int):
+    """Return the shared bedrock-runtime client for a region, creating it on first use"""
+    client = _BEDROCK_CLIENTS.get(region)
+    if client is None:
+        client = boto3.client(
+            service_name='bedrock-runtime',
+            region_name=region,
+            config=Config(
+                max_pool_connections=max_connections,
+                retries={"max_attempts": 3, "mode": "adaptive"},
+                tcp_keepalive=True,
+                connect_timeout=5,
+                read_timeout=60
+            )
+        )
+        _BEDROCK_CLIENTS[region] = client
+    return client
+
+def _env_flag(name: str) -> bool:
+    """Return whether an on/off environment variable is switched on"""
+    return os.getenv(name, '').lower() in ('1', 'true', 'yes')
+
 @dataclass
 class ConversationContext:
     """Maintains conversation context for better command generation"""
-    messages: List[Dict[str, str]]
+    __slots__ = ("messages", "last_command", "last_output", "timestamp")
+    messages: Deque[Dict[str, str]]
     last_command: Optional[str]
     last_output: Optional[str]
     timestamp: datetime
@@ -19,14 +63,25 @@ class ConversationContext:
 class LLMHandler(ServiceHandler):
     """Handler for LLM-based command understanding and processing using AWS Bedrock"""
 
+    # Maximum number of LLM responses (commands and summaries) kept in the response cache
+    RESPONSE_CACHE_SIZE = 1024
+    # Messages starting with these are already commands and skip the LLM
+    PASSTHROUGH_PREFIXES = ("kubectl ", "helm ")
+    # Maximum number of Bedrock calls in flight at once, protects the account quota
+    MAX_CONCURRENT_CALLS = 16
+    # Number of recent messages kept in the conversation context
+    CONTEXT_MESSAGES = 3
+    # Lines and characters of the last command output included in the prompt context
+    CONTEXT_OUTPUT_LINES = 40
+    CONTEXT_OUTPUT_CHARS = 4096
+    # Lowercase keywords marking output worth summarizing
+    ISSUE_KEYWORDS = ('error', 'warning', 'failed', 'not found', 'crash', 'exception', 'pending')
+
     def __init__(self):
         """Initialize the LLM handler with AWS Bedrock"""
         try:
-            # Initialize AWS Bedrock client
-            self.bedrock = boto3.client(
-                service_name='bedrock-runtime',
-                region_name=os.getenv('AWS_REGION', 'us-west-2')
-            )
+            # Initialize AWS Bedrock client, with a connection per allowed concurrent call
+            self.bedrock = _bedrock_client(os.getenv('AWS_REGION', 'us-west-2'), self.MAX_CONCURRENT_CALLS)
 
             # Select model based on provider
             self.model_id = os.getenv('LLM_MODEL_ID', 'anthropic.claude-3-sonnet-20240229-v1:0')
@@ -35,16 +90,34 @@ class LLMHandler(ServiceHandler):
             # Load the prompt template
             self.prompt_template = self._load_prompt_template()
 
+            # Mark the system prompt as a cache breakpoint for models that support prompt caching
+            self.prompt_caching = _env_flag('BEDROCK_PROMPT_CACHING')
+
+            # Encoded static request body prefixes keyed by system prompt
+            self._body_prefixes: Dict[Optional[str], bytes] = {}
+
+            # Extra invoke_model arguments, e.g. latency-optimized inference
+            self._invoke_kwargs = self._latency_kwargs(os.getenv('BEDROCK_LATENCY_MODE'))
+
             # Initialize conversation context
             self.conversation_context = ConversationContext(
-                messages=[],
+                messages=deque(maxlen=self.CONTEXT_MESSAGES),
                 last_command=None,
                 last_output=None,
                 timestamp=datetime.now()
             )
 
-            # Verify model access
-            self._verify_model_access()
+            # Bounds concurrent Bedrock calls; created on first use so it binds to the running loop
+            self._call_semaphore: Optional[asyncio.Semaphore] = None
+
+            # LRU cache of LLM responses keyed by a hash of the model, request and conversation state
+            self._response_cache: "OrderedDict[bytes, str]" = OrderedDict()
+            # LLM calls in flight keyed like the response cache, joined by identical requests
+            self._inflight: Dict[bytes, asyncio.Future] = {}
+
+            # Verifying model access costs a billed Bedrock call, so it is opt-in
+            if _env_flag('LLM_VERIFY_ON_INIT'):
+                self._verify_model_access()
 
             logger.info(f"Initialized LLM handler with model {self.model_id}")
 
@@ -54,14 +127,22 @@ class LLMHandler(ServiceHandler):
 
     def _load_prompt_template(self) -> str:
         """Load the prompt template from PROMPT.md"""
+        global _PROMPT_CACHE
+        if _PROMPT_CACHE is not None:
+            return _PROMPT_CACHE
         try:
             prompt_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'PROMPT.md')
             with open(prompt_path, 'r') as f:
                 content = f.read()
                 # Extract the prompt from the markdown file
                 # The prompt is between the first and second ``` markers
-                prompt = content.split('```')[1].strip()
-                return prompt
+                _, opening, rest = content.partition('```')
+                prompt, closing, _ = rest.partition('```')
+                prompt = prompt.strip()
+                if not (opening and closing and prompt):
+                    raise ValueError(f"no fenced prompt found in {prompt_path}")
+                _PROMPT_CACHE = prompt
+                return _PROMPT_CACHE
         except Exception as e:
             logger.error(f"Error loading prompt template: {str(e)}")
             # Fallback to hardcoded prompt if file reading fails
@@ -139,30 +220,154 @@ class LLMHandler(ServiceHandler):
         try:
             # Try a simple prompt to verify access
             test_prompt = "Hello, are you working?"
-            self._call_llm(test_prompt)
+            self._invoke_model(self._request_body(test_prompt))
             logger.info("Successfully verified LLM access")
         except Exception as e:
             logger.error(f"Failed to verify LLM access: {str(e)}")
             raise
 
-    async def _call_llm(self, prompt: str) -> str:
+    def _body_prefix(self, system: Optional[str]) -> bytes:
+        """Encode the static part of the request body once per system prompt, up to the
+        value of the trailing "messages" key"""
+        prefix = self._body_prefixes.get(system)
+        if prefix is None:
+            body = {
+                "anthropic_version": "bedrock-2023-05-31",
+                "max_tokens": 1024,
+                "temperature": 0.1  # Lower temperature for more consistent output
+            }
+            if system:
+                block = {"type": "text", "text": system}
+                if self.prompt_caching:
+                    block["cache_control"] = {"type": "ephemeral"}
+                body["system"] = [block]
+            prefix = _json_dumps(body)[:-1] + b',"messages":'
+            self._body_prefixes[system] = prefix
+        return prefix
+
+    def _request_body(self, prompt: str, system: Optional[str] = None) -> bytes:
+        """Encode the invoke_model request body for a prompt and optional system prompt"""
+        messages = [{
+            "role": "user",
+            "content": prompt
+        }]
+        return self._body_prefix(system) + _json_dumps(messages) + b"}"
+
+    def _latency_kwargs(self, mode: Optional[str]) -> Dict[str, str]:
+        """Build the invoke_model arguments selecting a latency mode ('optimized' or 'standard')"""
+        if not mode:
+            return {}
+        members = self.bedrock.meta.service_model.operation_model('InvokeModel').input_shape.members
+        if 'performanceConfigLatency' not in members:
+            logger.warning("BEDROCK_LATENCY_MODE is set but this botocore version does not support it, ignoring")
+            return {}
+        return {'performanceConfigLatency': mode}
+
+    def _invoke_model(self, body) -> Dict[str, Any]:
+        """Invoke the model on Bedrock and decode the response body"""
+        response = self.bedrock.invoke_model(modelId=self.model_id, body=body, **self._invoke_kwargs)
+        return _json_loads(response['body'].read())
+
+    def _stream_model(self, body, deliver: Callable[[Any], None], stop: threading.Event):
+        """Invoke the model with a streamed response and deliver each text delta, then None
+        (or the exception raised). Stops reading once stop is set."""
+        try:
+            response = self.bedrock.invoke_model_with_response_stream(
+                modelId=self.model_id, body=body, **self._invoke_kwargs
+            )
+            stream = response['body']
+            try:
+                for event in stream:
+                    if stop.is_set():
+                        break
+                    chunk = event.get('chunk')
+                    if not chunk:
+                        continue
+                    data = _json_loads(chunk['bytes'])
+                    if data.get('type') == 'content_block_delta':
+                        deliver(data['delta'].get('text', ''))
+            finally:
+                if hasattr(stream, 'close'):
+                    stream.close()
+            deliver(None)
+        except Exception as e:
+            deliver(e)
+
+    def _limiter(self) -> asyncio.Semaphore:
+        """Return the semaphore bounding concurrent Bedrock calls"""
+        if self._call_semaphore is None:
+            self._call_semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_CALLS)
+        return self._call_semaphore
+
+    async def _call_llm_stream(self, prompt: str, system: Optional[str] = None) -> AsyncIterator[str]:
+        """Call the LLM and yield the response text as it is generated"""
+        if self.provider != 'anthropic':
+            raise ValueError(f"Unsupported LLM provider: {self.provider}")
+
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+
+        def deliver(item):
+            # Nothing is listening any more once the consumer has stopped
+            if not stop.is_set():
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        async with self._limiter():
+            # boto3 is blocking, read the event stream in a worker thread
+            loop.run_in_executor(None, self._stream_model, self._request_body(prompt, system), deliver, stop)
+            try:
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        return
+                    if isinstance(item, Exception):
+                        logger.error(f"Error calling LLM: {str(item)}")
+                        raise item
+                    yield item
+            finally:
+                stop.set()
+
+    async def _stream_command(self, prompt: str, system: Optional[str] = None) -> str:
+        """Stream a response and return the command on its first line as soon as that line
+        is complete, without waiting for the rest of the generation"""
+        command = ""
+        buffer = ""
+        stream = self._call_llm_stream(prompt, system)
+        try:
+            async for delta in stream:
+                buffer += delta
+                while "\n" in buffer:
+                    line, _, buffer = buffer.partition("\n")
+                    line = line.strip()
+                    # Skip blank lines and markdown fences around the command
+                    if not line or line.startswith("```"):
+                        continue
+                    command = f"{command} {line}" if command else line
+                    # A chain may be continued on the next line
+                    if not command.endswith("&&"):
+                        return command
+        finally:
+            await stream.aclose()
+
+        line = buffer.strip()
+        if line and not line.startswith("```"):
+            command = f"{command} {line}" if command else line
+        if not command:
+            raise ValueError("Empty response from LLM")
+        return command
+
+    async def _call_llm(self, prompt: str, system: Optional[str] = None) -> str:
         """Call the LLM with a prompt and return the response"""
         try:
             if self.provider == 'anthropic':
-                response = self.bedrock.invoke_model(
-                    modelId=self.model_id,
-                    body=json.dumps({
-                        "anthropic_version": "bedrock-2023-05-31",
-                        "max_tokens": 1024,
-                        "messages": [{
-                            "role": "user",
-                            "content": prompt
-                        }],
-                        "temperature": 0.1  # Lower temperature for more consistent output
-                    })
-                )
-                response_body = json.loads(response['body'].read())
-                logger.debug(f"Raw LLM response: {json.dumps(response_body, indent=2)}")
+                body = self._request_body(prompt, system)
+                # boto3 is blocking, keep the Bedrock round trip off the event loop
+                loop = asyncio.get_running_loop()
+                async with self._limiter():
+                    response_body = await loop.run_in_executor(None, self._invoke_model, body)
+                # Only pretty-print the response when debug logging is actually enabled
+                logger.opt(lazy=True).debug("Raw LLM response: {}", lambda: json.dumps(response_body, indent=2))
 
                 # Check if we have the expected response structure
                 if 'content' not in response_body or not response_body['content']:
@@ -170,7 +375,7 @@ class LLMHandler(ServiceHandler):
 
                 # Return the full response text
                 response_text = response_body['content'][0]['text'].strip()
-                logger.debug(f"Full LLM response: {response_text}")
+                logger.debug("Full LLM response: {}", response_text)
                 return response_text
 
             else:
@@ -180,6 +385,65 @@ class LLMHandler(ServiceHandler):
             logger.error(f"Error calling LLM: {str(e)}")
             raise
 
+    def _cache_key(self, kind: str, *parts: Optional[str]) -> bytes:
+        """Hash the model id, request kind and request parts into a response cache key"""
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (self.model_id, kind) + parts:
+            digest.update((part or "").encode())
+            digest.update(b"\0")
+        return digest.digest()
+
+    def _cache_get(self, key: bytes) -> Optional[str]:
+        """Return a cached response and mark it as recently used"""
+        response = self._response_cache.get(key)
+        if response is not None:
+            self._response_cache.move_to_end(key)
+        return response
+
+    def _cache_put(self, key: bytes, response: str) -> str:
+        """Cache a response, evicting the least recently used one when full"""
+        if len(self._response_cache) >= self.RESPONSE_CACHE_SIZE:
+            self._response_cache.popitem(last=False)
+        self._response_cache[key] = response
+        return response
+
+    def _top_k_lines(self, output: str, k: int) -> str:
+        """Pick at most k lines of output in their original order: the header, then lines
+        mentioning an issue, then the most recent lines"""
+        lines = output.splitlines()
+        if len(lines) <= k:
+            return output
+
+        chosen = {0}
+        for i, line in enumerate(lines):
+            if len(chosen) >= k:
+                break
+            lowered = line.lower()
+            if any(keyword in lowered for keyword in self.ISSUE_KEYWORDS):
+                chosen.add(i)
+        i = len(lines) - 1
+        while len(chosen) < k:
+            chosen.add(i)
+            i -= 1
+        return "\n".join(lines[i] for i in sorted(chosen))
+
+    async def _coalesced(self, key: bytes, call: Callable[[], Awaitable[str]]) -> str:
+        """Run an LLM call and cache its response, sharing a single call between concurrent
+        identical requests"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish_inflight(key, done))
+        # Shield the shared call so one caller giving up doesn't cancel it for the others
+        return await asyncio.shield(task)
+
+    def _finish_inflight(self, key: bytes, task: asyncio.Future):
+        """Forget a finished shared call and cache its response if it succeeded"""
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self._cache_put(key, task.result())
+
     def _build_context(self, message: str) -> str:
         """Build context from conversation history"""
         context = []
@@ -188,10 +452,11 @@ class LLMHandler(ServiceHandler):
         if self.conversation_context.last_command:
             context.append(f"Last command executed: {self.conversation_context.last_command}")
         if self.conversation_context.last_output:
-            context.append(f"Last command output: {self.conversation_context.last_output}")
+            output = self._top_k_lines(self.conversation_context.last_output, self.CONTEXT_OUTPUT_LINES)
+            context.append(f"Last command output: {output[:self.CONTEXT_OUTPUT_CHARS]}")
 
-        # Add relevant conversation history
-        for msg in self.conversation_context.messages[-3:]:  # Keep last 3 messages
+        # Add relevant conversation history, the deque only holds the most recent messages
+        for msg in self.conversation_context.messages:
             context.append(f"{msg['role']}: {msg['content']}")
 
         return "\n".join(context)
@@ -205,23 +470,35 @@ class LLMHandler(ServiceHandler):
                 "content": message
             })
 
-            # Build context-aware prompt
-            context = self._build_context(message)
-            prompt = f"{self.prompt_template}\n\nContext:\n{context}\n\nUser: {message}\nCommand:"
-
-            # Call the LLM
-            response = await self._call_llm(prompt)
+            # Commands pasted as-is need no translation, execute_command still validates them
+            text = message.strip()
+            if text.startswith(self.PASSTHROUGH_PREFIXES):
+                command = text
+            else:
+                # Repeated requests are answered from the cache instead of another Bedrock call.
+                # The last command and output are part of the key so follow-ups don't collide.
+                key = self._cache_key(
+                    "command",
+                    self.conversation_context.last_command,
+                    self.conversation_context.last_output,
+                    text
+                )
+                command = self._cache_get(key)
+                if command is None:
+                    # Build context-aware prompt, the static template goes in the system prompt
+                    context = self._build_context(message)
+                    prompt = f"Context:\n{context}\n\nUser: {message}\nCommand:"
 
-            # Extract the command from the response
-            command = response.strip()
+                    # Call the LLM, the command is ready as soon as its line has been streamed
+                    command = await self._coalesced(key, lambda: self._stream_command(prompt, system=self.prompt_template))
 
-            # Update conversation context with the command
+            # Update conversation context with the command, every path above yields it stripped
             self.conversation_context.last_command = command
 
             return {
                 "success": True,
                 "command": command,
-                "response": response
+                "response": command
             }
 
         except Exception as e:
@@ -237,6 +514,12 @@ class LLMHandler(ServiceHandler):
             # Update conversation context with the output
             self.conversation_context.last_output = output
 
+            # The same output after the same command gets the same summary
+            key = self._cache_key("summary", self.conversation_context.last_command, output)
+            cached = self._cache_get(key)
+            if cached is not None:
+                return cached
+
             # Check for ContainerCreating state
             if "ContainerCreating" in output:
                 # Build a more detailed prompt for ContainerCreating analysis
@@ -261,11 +544,11 @@ class LLMHandler(ServiceHandler):
                 4. Diagnostic Commands
                 """
 
-                summary = await self._call_llm(prompt)
-                return summary.strip()
+                return await self._coalesced(key, lambda: self._call_llm(prompt))
 
-            # For other types of output, use the existing logic
-            if not any(keyword in output.lower() for keyword in ['error', 'warning', 'failed', 'not found', 'crash', 'exception', 'pending']):
+            # For other types of output, use the existing logic. Lowercase once rather than per keyword.
+            lowered = output.lower()
+            if not any(keyword in lowered for keyword in self.ISSUE_KEYWORDS):
                 return "No issues found in the output."
 
             # Build context-aware prompt for summarization
@@ -286,8 +569,7 @@ class LLMHandler(ServiceHandler):
 
             Summary:"""
 
-            summary = await self._call_llm(prompt)
-            return summary.strip()
+            return await self._coalesced(key, lambda: self._call_llm(prompt))
 
         except Exception as e:
             logger.error(f"Error summarizing output: {str(e)}")
@@ -4,16 +4,20 @@ from pydantic import BaseModel
 from loguru import logger
 import uvicorn
 import yaml
+from functools import lru_cache
 from typing import Dict, Any, Optional, List, Union
+import asyncio
 import os
 import sys
 from pathlib import Path
-from kubernetes import client, config
 from autogen_core import ComponentModel
 from autogen_core.models import SystemMessage, UserMessage
 from autogen_core.model_context import ChatCompletionContext
-import io
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime
+from itertools import islice
 
 # Add the src directory to Python path
 src_path = str(Path(__file__).parent)
@@ -27,7 +31,31 @@ from llm_handler import LLMHandler
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="Kubernetes MCP Server")
+# libyaml's C loader is much faster than the pure-Python one when PyYAML was built with it
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Service handlers, constructed at startup so importing the app stays cheap
+service_handlers: Dict[str, Any] = {}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Construct the service handlers in worker threads, off the event loop"""
+    loop = asyncio.get_running_loop()
+    # One pool for all blocking calls (Bedrock, Kubernetes API). The default executor only has
+    # min(32, CPUs + 4) threads, fewer than LLMHandler.MAX_CONCURRENT_CALLS on small nodes.
+    loop.set_default_executor(ThreadPoolExecutor(
+        max_workers=int(os.getenv("ASYNC_MAX_WORKERS", "32")),
+        thread_name_prefix="mcp"
+    ))
+    kubernetes_handler, llm_handler = await asyncio.gather(
+        loop.run_in_executor(None, lambda: KubernetesHandler(security_mode=SecurityMode.PERMISSIVE)),
+        loop.run_in_executor(None, LLMHandler)
+    )
+    service_handlers["kubernetes"] = kubernetes_handler
+    service_handlers["llm"] = llm_handler
+    yield
+
+app = FastAPI(title="Kubernetes MCP Server", lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -38,27 +66,23 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-# Initialize Kubernetes client
-try:
-    config.load_incluster_config()  # Try loading in-cluster config first
-except config.ConfigException:
-    try:
-        config.load_kube_config()  # Fall back to local kubeconfig
-    except config.ConfigException:
-        logger.warning("Could not load Kubernetes config. Commands will be simulated.")
-
-k8s_api = client.CoreV1Api()
-k8s_apps_api = client.AppsV1Api()
+# Add a memory handler keeping the most recent log records for /api/logs
+LOG_BUFFER_SIZE = 10000
+# Longest message kept per record, so records carrying command output stay small
+LOG_MESSAGE_CHARS = 2000
+log_buffer = deque(maxlen=LOG_BUFFER_SIZE)
 
-# Initialize service handlers
-service_handlers = {
-    "kubernetes": KubernetesHandler(security_mode=SecurityMode.PERMISSIVE),
-    "llm": LLMHandler()
-}
+def capture_log(message):
+    """Loguru sink storing each record as a (timestamp, level, message) tuple"""
+    record = message.record
+    log_buffer.append((
+        record["time"].strftime("%Y-%m-%d %H:%M:%S"),
+        record["level"].name,
+        record["message"][:LOG_MESSAGE_CHARS]
+    ))
 
-# Add a memory handler to capture logs
-log_capture = io.StringIO()
-logger.add(log_capture, format="{time:YYYY-MM-DD HH:mm:ss} | {level} | {message}")
+# Debug records embed whole command outputs and responses, so they are not kept
+logger.add(capture_log, level="INFO")
 
 # Simplified request models
 class Message(BaseModel):
@@ -75,6 +99,9 @@ class CommandRequest(BaseModel):
     command: str
     parameters: Optional[Dict[str, Any]] = None
 
+class BatchCommandRequest(BaseModel):
+    commands: List[str]
+
 class MessageRequest(BaseModel):
     message: str
     namespace: Optional[str] = "default"
@@ -109,17 +136,21 @@ async def root() -> Dict[str, str]:
 async def list_services() -> Dict[str, Dict[str, Any]]:
     """List available services and their capabilities"""
     services_info = {}
-    for service_name, handler in service_handlers.items():
-        try:
-            info = await handler.get_service_info()
-            services_info[service_name] = {
-                "name": service_name,
-                "capabilities": info.get("capabilities", []),
-                "model": info.get("model")
-            }
-        except Exception as e:
-            logger.error(f"Error getting info for service {service_name}: {str(e)}")
-            services_info[service_name] = {"error": str(e)}
+    # Query every handler at once so the slowest one bounds the latency
+    results = await asyncio.gather(
+        *(handler.get_service_info() for handler in service_handlers.values()),
+        return_exceptions=True
+    )
+    for service_name, info in zip(service_handlers, results):
+        if isinstance(info, Exception):
+            logger.error(f"Error getting info for service {service_name}: {str(info)}")
+            services_info[service_name] = {"error": str(info)}
+            continue
+        services_info[service_name] = {
+            "name": service_name,
+            "capabilities": info.get("capabilities", []),
+            "model": info.get("model")
+        }
     return services_info
 
 @app.post("/command")
@@ -140,6 +171,19 @@ async def handle_command(request: CommandRequest) -> CommandResult:
         logger.error(f"Error executing command: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/commands")
+async def handle_commands(request: BatchCommandRequest) -> Dict[str, Any]:
+    """Handle a batch of direct commands, executed concurrently when all are read-only"""
+    try:
+        results = await service_handlers["kubernetes"].handle_commands(request.commands)
+        return {"results": results}
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error executing commands: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/nl")
 async def handle_natural_language(request: NaturalLanguageRequest):
     """Handle natural language requests"""
@@ -179,10 +223,12 @@ async def handle_natural_language(request: NaturalLanguageRequest):
             "output": result.get("command_result", {}).get("raw_output", ""),  # Use output instead of raw_output
             "summary": result.get("summary", ""),
             "analysis": result.get("command_result", {}).get("analysis", {}),  # Include analysis if available
+            "truncated": result.get("command_result", {}).get("truncated", False),  # Output was cut at the size cap
             "error": result.get("command_result", {}).get("error")  # Include error if any
         }
 
-        logger.debug(f"Returning response: {response}")
+        # The response embeds the full command output, only format it when debug is enabled
+        logger.debug("Returning response: {}", response)
         return response
 
     except Exception as e:
@@ -201,6 +247,8 @@ async def handle_message(message: Message) -> Dict[str, Any]:
             return {"status": "success", "data": message.payload}
         else:
             raise HTTPException(status_code=400, detail=f"Unknown message type: {message.type}")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -357,35 +405,24 @@ async def health_check():
 async def get_logs(limit: int = 100):
     """Get recent logs"""
     try:
-        # Get logs from the capture buffer
-        log_contents = log_capture.getvalue()
-        log_lines = log_contents.strip().split('\n')[-limit:]
-
-        logs = []
-        for line in log_lines:
-            try:
-                # Parse log line: "2024-03-21 10:30:45 | INFO | message"
-                timestamp_str, level, message = line.split(' | ', 2)
-                logs.append(LogEntry(
-                    timestamp=timestamp_str,
-                    level=level,
-                    message=message
-                ))
-            except ValueError:
-                # Skip malformed log lines
-                continue
-
+        # Walk back from the newest record so only the requested entries are touched
+        recent = list(islice(reversed(log_buffer), max(limit, 0)))
+        logs = [
+            LogEntry(timestamp=timestamp, level=level, message=message)
+            for timestamp, level, message in reversed(recent)
+        ]
         return LogResponse(logs=logs)
     except Exception as e:
         logger.error(f"Error retrieving logs: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@lru_cache(maxsize=1)
 def load_config() -> Dict[str, Any]:
-    """Load server configuration"""
+    """Load server configuration, parsed once per process"""
     config_path = os.getenv("CONFIG_PATH", "config.yaml")
     try:
         with open(config_path, "r") as f:
-            return yaml.safe_load(f)
+            return yaml.load(f, Loader=YamlLoader)
     except FileNotFoundError:
         logger.warning(f"Config file not found at {config_path}, using defaults")
         return {
@@ -0,0 +1,358 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+# The handlers import their siblings by module name, as server.py arranges
+sys.path.append(str(Path(__file__).parent.parent / "src"))
+
+from kubernetes_handler import KubernetesHandler, SecurityMode
+
+@pytest.fixture
+def strict_handler():
+    """Strict-mode handler; constructing it must not need a kubeconfig"""
+    return KubernetesHandler(security_mode=SecurityMode.STRICT)
+
+@pytest.mark.asyncio
+async def test_allowed_commands(strict_handler):
+    """Test that well-formed allowed commands pass validation"""
+    assert await strict_handler.validate_command("kubectl get pods -n default")
+    assert await strict_handler.validate_command("kubectl describe pod web-1")
+    assert await strict_handler.validate_command("kubectl exec web-1 -- ls -la")
+    assert await strict_handler.validate_command("helm list --all-namespaces")
+    # Any whitespace separates the tool from its subcommand
+    assert await strict_handler.validate_command("kubectl\tget pods")
+
+@pytest.mark.asyncio
+async def test_forbidden_commands(strict_handler):
+    """Test that forbidden flags and structural patterns are rejected"""
+    assert not await strict_handler.validate_command("kubectl delete pod web-1 --force")
+    assert not await strict_handler.validate_command("kubectl get pods --token=abc")
+    assert not await strict_handler.validate_command("kubectl delete namespace kube-system")
+    assert not await strict_handler.validate_command("kubectl get pods --v=9")
+
+@pytest.mark.asyncio
+async def test_unknown_commands(strict_handler):
+    """Test that commands outside the allowed set are rejected"""
+    assert not await strict_handler.validate_command("kubectl get foo")
+    assert not await strict_handler.validate_command("rm -rf /")
+    assert not await strict_handler.validate_command("kubectl")
+    assert not await strict_handler.validate_command("kubectlx get pods")
+
+@pytest.mark.asyncio
+async def test_validation_results_are_cached(monkeypatch, strict_handler):
+    """Test that repeated commands reuse the cached result and the oldest entry is evicted"""
+    validated = []
+    validate = strict_handler._validate_command
+
+    def counting_validate(command):
+        validated.append(command)
+        return validate(command)
+
+    monkeypatch.setattr(strict_handler, "_validate_command", counting_validate)
+    monkeypatch.setattr(strict_handler, "VALIDATE_CACHE_SIZE", 2)
+    assert await strict_handler.validate_command("kubectl get pods")
+    assert await strict_handler.validate_command("kubectl get pods")
+    assert not await strict_handler.validate_command("kubectl get foo")
+    assert validated == ["kubectl get pods", "kubectl get foo"]
+
+    # A third command evicts the oldest one, which is validated again
+    await strict_handler.validate_command("kubectl get svc")
+    await strict_handler.validate_command("kubectl get foo")
+    await strict_handler.validate_command("kubectl get pods")
+    assert validated[2:] == ["kubectl get svc", "kubectl get pods"]
+
+def test_frequent_forbidden_literals_move_first(monkeypatch, strict_handler):
+    """Test that hit counts re-order the forbidden literals every FORBIDDEN_RESORT_INTERVAL validations"""
+    monkeypatch.setattr(strict_handler, "FORBIDDEN_RESORT_INTERVAL", 4)
+    assert list(strict_handler._forbidden_literals)[0] == "--privileged"
+    for _ in range(2):
+        assert not strict_handler._validate_command("kubectl delete pod web-1 --force")
+    assert not strict_handler._validate_command("kubectl get pods --raw")
+    assert list(strict_handler._forbidden_literals)[0] == "--privileged"
+
+    # The fourth validation triggers the re-sort, most hits first
+    strict_handler._validate_command("kubectl get pods")
+    assert list(strict_handler._forbidden_literals)[:2] == ["--force", "--raw"]
+
+@pytest.mark.asyncio
+async def test_permissive_mode():
+    """Test that permissive mode accepts any command"""
+    handler = KubernetesHandler(security_mode=SecurityMode.PERMISSIVE)
+    assert await handler.validate_command("kubectl apply -f deployment.yaml")
+
+@pytest.mark.asyncio
+async def test_get_pods_in_process(strict_handler):
+    """Test that 'kubectl get pods -n <ns>' is served by the API client as a kubectl-style table"""
+    from datetime import datetime, timedelta, timezone
+    from kubernetes import client
+
+    pod = client.V1Pod(
+        metadata=client.V1ObjectMeta(
+            name="web-1",
+            namespace="shop",
+            creation_timestamp=datetime.now(timezone.utc) - timedelta(hours=3, minutes=12)
+        ),
+        spec=client.V1PodSpec(containers=[client.V1Container(name="web")]),
+        status=client.V1PodStatus(
+            phase="Running",
+            container_statuses=[client.V1ContainerStatus(
+                name="web", image="nginx", image_id="", ready=False, restart_count=4,
+                state=client.V1ContainerState(waiting=client.V1ContainerStateWaiting(reason="CrashLoopBackOff"))
+            )]
+        )
+    )
+
+    class FakeCoreV1Api:
+        def list_namespaced_pod(self, namespace, _request_timeout=None):
+            assert namespace == "shop"
+            assert _request_timeout == KubernetesHandler.IN_PROCESS_TIMEOUT
+            return client.V1PodList(items=[pod])
+
+    strict_handler.v1 = FakeCoreV1Api()
+    output = await strict_handler._execute_in_process("kubectl get pods -n shop")
+    assert output.splitlines() == [
+        "NAME    READY   STATUS             RESTARTS   AGE",
+        "web-1   0/1     CrashLoopBackOff   4          3h12m"
+    ]
+
+    # Commands the fast path does not cover fall back to kubectl
+    assert await strict_handler._execute_in_process("kubectl get pods") is None
+    assert await strict_handler._execute_in_process("kubectl get pods -n shop -o yaml") is None
+
+def test_config_follows_kubectl_order(monkeypatch, tmp_path, strict_handler):
+    """Test that a kubeconfig is preferred over the in-cluster config, as kubectl does"""
+    import kubernetes_handler
+    loaded = []
+    monkeypatch.setattr(kubernetes_handler.config, "load_kube_config", lambda: loaded.append("kubeconfig"))
+    monkeypatch.setattr(kubernetes_handler.config, "load_incluster_config", lambda: loaded.append("in-cluster"))
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setenv("KUBECONFIG", str(tmp_path / "config"))
+    strict_handler._ensure_config()
+    assert loaded == ["kubeconfig"]
+
+    monkeypatch.delenv("KUBECONFIG")
+    KubernetesHandler()._ensure_config()
+    assert loaded == ["kubeconfig", "in-cluster"]
+
+@pytest.mark.asyncio
+async def test_config_failure_skips_the_fast_path(monkeypatch, tmp_path, strict_handler):
+    """Test that a failed config load is remembered and later gets go straight to kubectl"""
+    import kubernetes_handler
+    attempts = []
+
+    def fail():
+        attempts.append(1)
+        raise kubernetes_handler.config.ConfigException("no service account")
+
+    monkeypatch.setattr(kubernetes_handler.config, "load_incluster_config", fail)
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.delenv("KUBECONFIG", raising=False)
+    assert await strict_handler._execute_in_process("kubectl get pods -n shop") is None
+    assert await strict_handler._execute_in_process("kubectl get pods -n shop") is None
+    assert len(attempts) == 1
+
+def test_pod_columns_match_kubectl(strict_handler):
+    """Test that init containers and recent restarts are reported the way kubectl prints them"""
+    from datetime import datetime, timedelta, timezone
+    from kubernetes import client
+
+    now = datetime.now(timezone.utc)
+
+    def status(name, restarts=0, waiting=None, terminated=None, running=False, ready=False, finished_ago=None):
+        last_state = None
+        if finished_ago is not None:
+            last_state = client.V1ContainerState(terminated=client.V1ContainerStateTerminated(
+                exit_code=1, finished_at=now - finished_ago
+            ))
+        return client.V1ContainerStatus(
+            name=name, image="img", image_id="", ready=ready, restart_count=restarts, last_state=last_state,
+            state=client.V1ContainerState(
+                waiting=client.V1ContainerStateWaiting(reason=waiting) if waiting else None,
+                terminated=client.V1ContainerStateTerminated(exit_code=terminated) if terminated is not None else None,
+                running=client.V1ContainerStateRunning() if running else None
+            )
+        )
+
+    def pod(containers, init_containers=()):
+        return client.V1Pod(
+            metadata=client.V1ObjectMeta(name="web-1"),
+            spec=client.V1PodSpec(
+                containers=[client.V1Container(name=cs.name) for cs in containers],
+                init_containers=[client.V1Container(name=cs.name) for cs in init_containers] or None
+            ),
+            status=client.V1PodStatus(
+                phase="Pending", container_statuses=list(containers), init_container_statuses=list(init_containers)
+            )
+        )
+
+    app = status("web", waiting="PodInitializing")
+    assert strict_handler._pod_columns(
+        pod([app], [status("migrate", waiting="ImagePullBackOff")]), now
+    ) == ("0/1", "Init:ImagePullBackOff", "0")
+    assert strict_handler._pod_columns(
+        pod([app], [status("migrate", terminated=0), status("seed", running=True)]), now
+    ) == ("0/1", "Init:1/2", "0")
+    assert strict_handler._pod_columns(
+        pod([app], [status("migrate", restarts=3, terminated=2, finished_ago=timedelta(minutes=5))]), now
+    ) == ("0/1", "Init:ExitCode:2", "3 (5m ago)")
+
+    running = pod([status("web", restarts=2, running=True, ready=True, finished_ago=timedelta(minutes=7))])
+    running.status.phase = "Running"
+    assert strict_handler._pod_columns(running, now) == ("1/1", "Running", "2 (7m ago)")
+
+    table = "NAME    READY   STATUS                  RESTARTS   AGE\nweb-1   0/1     Init:ImagePullBackOff   0          1m"
+    assert strict_handler._analyze_output(table)["state"] == "ImagePullBackOff"
+
+@pytest.mark.asyncio
+async def test_api_resources_are_cached_for_ttl(strict_handler):
+    """Test that get_service_info reuses the API resources until API_RESOURCES_TTL expires"""
+    calls = []
+
+    class FakeCoreV1Api:
+        def get_api_resources(self):
+            calls.append(1)
+            return f"resources-{len(calls)}"
+
+    strict_handler.v1 = FakeCoreV1Api()
+    assert (await strict_handler.get_service_info())["version"] == "resources-1"
+    assert (await strict_handler.get_service_info())["version"] == "resources-1"
+    assert len(calls) == 1
+
+    # Age the cached entry past the TTL
+    strict_handler._api_resources_ts -= strict_handler.API_RESOURCES_TTL
+    assert (await strict_handler.get_service_info())["version"] == "resources-2"
+    assert len(calls) == 2
+
+@pytest.mark.asyncio
+async def test_handle_commands_rejects_invalid_batch(strict_handler):
+    """Test that a batch is rejected before anything runs if any command is invalid"""
+    with pytest.raises(ValueError, match="Invalid command"):
+        await strict_handler.handle_commands(["kubectl get pods -n default", "kubectl delete pod web-1 --force"])
+
+@pytest.mark.asyncio
+async def test_handle_commands_bounds_the_batch(monkeypatch, strict_handler):
+    """Test that oversized batches are rejected and the rest run BATCH_CONCURRENCY at a time"""
+    with pytest.raises(ValueError, match="Too many commands"):
+        await strict_handler.handle_commands(["kubectl get pods -n default"] * (strict_handler.MAX_BATCH_COMMANDS + 1))
+
+    active = []
+    peak = []
+
+    async def fake_execute(command, max_output_bytes=None):
+        active.append(command)
+        peak.append(len(active))
+        await asyncio.sleep(0.01)
+        active.remove(command)
+        return {"success": True, "output": command}
+
+    monkeypatch.setattr(strict_handler, "BATCH_CONCURRENCY", 3)
+    monkeypatch.setattr(strict_handler, "_execute_prevalidated", fake_execute)
+    commands = [f"kubectl get pods -n ns{i}" for i in range(10)]
+    results = await strict_handler.handle_commands(commands)
+    assert [result["command"] for result in results] == commands
+    assert max(peak) == 3
+
+@pytest.mark.asyncio
+async def test_dependent_batch_runs_in_order(tmp_path):
+    """Test that a batch with side effects runs its commands in order"""
+    handler = KubernetesHandler(security_mode=SecurityMode.PERMISSIVE)
+    target = tmp_path / "d"
+    results = await handler.handle_commands([f"sh -c 'sleep 0.3; mkdir {target}'", f"touch {target}/f"])
+    assert all(result["success"] for result in results)
+    assert (target / "f").exists()
+
+@pytest.mark.asyncio
+async def test_output_is_truncated():
+    """Test that output beyond max_output_bytes is dropped and the process is stopped"""
+    handler = KubernetesHandler(security_mode=SecurityMode.PERMISSIVE)
+    result = await handler.execute_command("yes hello", max_output_bytes=1000)
+    assert result["success"]
+    assert result["truncated"]
+    assert 0 < len(result["output"]) <= 1000
+
+def test_split_command_leaves_shell_features_to_the_shell(strict_handler):
+    """Test that commands needing shell expansion are not exec'd directly"""
+    assert strict_handler._split_command("kubectl get pods -n 'my ns'") == ["kubectl", "get", "pods", "-n", "my ns"]
+    assert strict_handler._split_command("kubectl get pods | grep web") is None
+    assert strict_handler._split_command("kubectl --kubeconfig ~/.kube/config get pods") is None
+    assert strict_handler._split_command("KUBECONFIG=/x kubectl get pods") is None
+    assert strict_handler._split_command("kubectl get pods # list all") is None
+    # Assignments elsewhere are ordinary arguments
+    assert strict_handler._split_command("kubectl get pods -l app=web") == ["kubectl", "get", "pods", "-l", "app=web"]
+
+def test_merge_get_chain(strict_handler):
+    """Test that 'kubectl get' chains with identical arguments merge into one command"""
+    assert strict_handler._merge_get_chain(
+        ["kubectl get pods -n shop", "kubectl get services -n shop"]
+    ) == "kubectl get pods,services -n shop"
+    # Differing arguments, resource names and shell syntax are left alone
+    assert strict_handler._merge_get_chain(["kubectl get pods -n shop", "kubectl get services"]) is None
+    assert strict_handler._merge_get_chain(["kubectl get pod/web-1", "kubectl get svc/web"]) is None
+    assert strict_handler._merge_get_chain(["kubectl get pods | grep web", "kubectl get svc"]) is None
+
+@pytest.mark.asyncio
+async def test_merged_chain_keeps_chain_result_shape(monkeypatch, strict_handler):
+    """Test that a merged 'kubectl get' chain is reported like any other chain"""
+    ran = []
+
+    async def fake_run(command, max_output_bytes=None):
+        ran.append(command)
+        return 0, "NAME    READY   STATUS\nweb-1   1/1     Running", "", False
+
+    monkeypatch.setattr(strict_handler, "_run", fake_run)
+    result = await strict_handler._execute_prevalidated("kubectl get pods -n shop && kubectl get services -n shop")
+    assert ran == ["kubectl get pods,services -n shop"]
+    assert result["success"]
+    assert result["output"].startswith("=== Output from: kubectl get pods,services -n shop ===\nNAME")
+    assert result["analysis"]["partial_success"]
+
+def test_analyze_output(strict_handler):
+    """Test pod-state analysis of plain command output"""
+    analysis = strict_handler._analyze_output("web-1   0/1   Pending   0   1m\nFailedScheduling: Insufficient cpu")
+    assert analysis["state"] == "Pending"
+    assert analysis["issues"] == ["Insufficient resources", "Scheduling failure"]
+    assert strict_handler._analyze_output("web-1   1/1   Running   0   1m")["state"] is None
+
+@pytest.mark.asyncio
+async def test_container_creating_fetches_details_concurrently(monkeypatch, strict_handler):
+    """Test that the pod description and namespace events are fetched at the same time"""
+    started = []
+    both_started = asyncio.Event()
+
+    async def fake_execute(command):
+        started.append(command)
+        if len(started) == 2:
+            both_started.set()
+        # Deadlocks unless the other fetch was started before this one finishes
+        await asyncio.wait_for(both_started.wait(), timeout=1)
+        output = "Warning  FailedMount  volume missing" if "describe" in command else "FailedScheduling"
+        return {"success": True, "output": output}
+
+    monkeypatch.setattr(strict_handler, "execute_command", fake_execute)
+    analysis = await strict_handler._analyze_container_creating(
+        "kubectl describe pods web-1 -n shop",
+        {"state": "ContainerCreating", "issues": [], "recommendations": []}
+    )
+    assert analysis["issues"] == ["Pod scheduling failed", "Volume mount failed"]
+    assert analysis["details"]["namespace"] == "shop"
+    assert analysis["details"]["events"] == "FailedScheduling"
+
+@pytest.mark.asyncio
+async def test_dependent_chain_runs_in_order(tmp_path):
+    """Test that a chain with side effects runs its parts in order"""
+    handler = KubernetesHandler(security_mode=SecurityMode.PERMISSIVE)
+    target = tmp_path / "d"
+    result = await handler.execute_command(f"sh -c 'sleep 0.3; mkdir {target}' && touch {target}/f")
+    assert result["success"]
+    assert "Error from" not in result["output"]
+    assert (target / "f").exists()
+
+def test_only_read_only_chains_are_concurrent(strict_handler):
+    """Test which chain parts count as read-only"""
+    assert strict_handler._is_read_only("kubectl get pods -n shop")
+    assert strict_handler._is_read_only("kubectl logs web-1")
+    assert not strict_handler._is_read_only("kubectl create namespace shop")
+    assert not strict_handler._is_read_only("kubectl get pods | grep web")
+    assert not strict_handler._is_read_only("helm list")
@@ -0,0 +1,275 @@
+import asyncio
+import io
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent / "src"))
+
+import llm_handler
+from llm_handler import LLMHandler
+
+
+class FakeBedrock:
+    """Stand-in for the bedrock-runtime client that records each invoke_model call"""
+
+    def __init__(self, text="kubectl get pods -n default"):
+        self.text = text
+        self.calls = []
+        self.delay = 0
+        invoke_model = SimpleNamespace(input_shape=SimpleNamespace(members={"performanceConfigLatency": None}))
+        self.meta = SimpleNamespace(service_model=SimpleNamespace(operation_model=lambda name: invoke_model))
+
+    def invoke_model(self, modelId, body, **kwargs):
+        self.calls.append({
+            "modelId": modelId,
+            "body": json.loads(body),
+            "kwargs": kwargs,
+            "thread": threading.get_ident()
+        })
+        payload = json.dumps({"content": [{"type": "text", "text": f"  {self.text}\n"}]})
+        return {"body": io.BytesIO(payload.encode())}
+
+    def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+        self.invoke_model(modelId, body, **kwargs)
+        self.streamed = 0
+
+        def events():
+            yield {"chunk": {"bytes": json.dumps({"type": "message_start"}).encode()}}
+            text = f"  {self.text}\n"
+            for start in range(0, len(text), 8):
+                self.streamed += 1
+                delta = {"type": "content_block_delta", "delta": {"type": "text_delta", "text": text[start:start + 8]}}
+                yield {"chunk": {"bytes": json.dumps(delta).encode()}}
+                time.sleep(self.delay)
+            yield {"chunk": {"bytes": json.dumps({"type": "message_stop"}).encode()}}
+
+        return {"body": events()}
+
+
+@pytest.fixture
+def bedrock(monkeypatch):
+    fake = FakeBedrock()
+    monkeypatch.setattr(llm_handler.boto3, "client", lambda **kwargs: fake)
+    monkeypatch.setattr(llm_handler, "_BEDROCK_CLIENTS", {})
+    return fake
+
+
+@pytest.fixture
+def handler(bedrock):
+    return LLMHandler()
+
+
+@pytest.mark.asyncio
+async def test_call_llm_runs_off_the_event_loop(handler, bedrock):
+    """Bedrock is invoked from a worker thread and the response text is stripped"""
+    assert await handler._call_llm("list pods") == "kubectl get pods -n default"
+    assert len(bedrock.calls) == 1
+    call = bedrock.calls[0]
+    assert call["thread"] != threading.get_ident()
+    assert call["body"]["messages"] == [{"role": "user", "content": "list pods"}]
+
+
+@pytest.mark.asyncio
+async def test_understand_command_caches_responses(handler, bedrock):
+    """A repeated message in the same conversation state is answered from the cache"""
+    first = await handler.understand_command("show me the pods")
+    handler.conversation_context.last_command = None
+    second = await handler.understand_command("show me the pods ")
+    assert first["command"] == second["command"] == "kubectl get pods -n default"
+    assert len(bedrock.calls) == 1
+
+    # A different previous command or model changes the key
+    await handler.understand_command("show me the pods")
+    assert len(bedrock.calls) == 2
+    handler.model_id = "anthropic.other-model"
+    await handler.understand_command("show me the pods")
+    assert len(bedrock.calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_summarize_output_caches_responses(handler, bedrock):
+    """The same output is only summarized once"""
+    output = "web-1   0/1   Pending   0   1m"
+    assert await handler.summarize_output(output) == await handler.summarize_output(output)
+    assert len(bedrock.calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_understand_command_passes_commands_through(handler, bedrock):
+    """Messages that are already kubectl or helm commands skip the LLM"""
+    result = await handler.understand_command("  kubectl get svc -n kube-system\n")
+    assert result["success"]
+    assert result["command"] == "kubectl get svc -n kube-system"
+    assert handler.conversation_context.last_command == "kubectl get svc -n kube-system"
+    assert bedrock.calls == []
+
+
+def test_model_access_is_verified_only_on_request(monkeypatch, bedrock):
+    """No Bedrock call is made at init unless LLM_VERIFY_ON_INIT is set"""
+    monkeypatch.delenv("LLM_VERIFY_ON_INIT", raising=False)
+    LLMHandler()
+    assert bedrock.calls == []
+
+    monkeypatch.setenv("LLM_VERIFY_ON_INIT", "true")
+    LLMHandler()
+    assert len(bedrock.calls) == 1
+
+
+def test_prompt_template_is_loaded_once(monkeypatch, bedrock):
+    """PROMPT.md is read on first use and shared by later handlers"""
+    monkeypatch.setattr(llm_handler, "_PROMPT_CACHE", None)
+    first = LLMHandler()
+    assert first.prompt_template and "```" not in first.prompt_template
+
+    monkeypatch.setattr("builtins.open", lambda *args, **kwargs: pytest.fail("PROMPT.md read twice"))
+    assert LLMHandler().prompt_template == first.prompt_template
+
+
+def test_prompt_template_without_fence_falls_back(monkeypatch, bedrock):
+    """A PROMPT.md without a fenced prompt uses the built-in prompt and is not cached"""
+    monkeypatch.setattr(llm_handler, "_PROMPT_CACHE", None)
+    monkeypatch.setattr("builtins.open", lambda *args, **kwargs: io.StringIO("# Prompt\nNo fence here\n"))
+    assert LLMHandler().prompt_template.startswith("You are a Kubernetes expert.")
+    assert llm_handler._PROMPT_CACHE is None
+
+
+@pytest.mark.asyncio
+async def test_prompt_template_is_sent_as_system_prompt(monkeypatch, bedrock):
+    """The static template goes in the system prompt, cached only when enabled"""
+    handler = LLMHandler()
+    await handler.understand_command("show me the pods")
+    body = bedrock.calls[-1]["body"]
+    assert body["system"] == [{"type": "text", "text": handler.prompt_template}]
+    assert handler.prompt_template not in body["messages"][0]["content"]
+    assert body["messages"][0]["content"].endswith("User: show me the pods\nCommand:")
+
+    monkeypatch.setenv("BEDROCK_PROMPT_CACHING", "true")
+    handler = LLMHandler()
+    await handler.understand_command("show me the pods")
+    assert bedrock.calls[-1]["body"]["system"][0]["cache_control"] == {"type": "ephemeral"}
+
+
+@pytest.mark.asyncio
+async def test_latency_mode_is_passed_to_invoke_model(monkeypatch, bedrock):
+    """BEDROCK_LATENCY_MODE is forwarded as performanceConfigLatency"""
+    await LLMHandler()._call_llm("list pods")
+    assert bedrock.calls[-1]["kwargs"] == {}
+
+    monkeypatch.setenv("BEDROCK_LATENCY_MODE", "optimized")
+    await LLMHandler()._call_llm("list pods")
+    assert bedrock.calls[-1]["kwargs"] == {"performanceConfigLatency": "optimized"}
+
+
+@pytest.mark.asyncio
+async def test_understand_command_stops_streaming_after_the_command(handler, bedrock):
+    """The command is returned once its line is complete, ignoring fences and later text"""
+    bedrock.delay = 0.01
+    bedrock.text = "```bash\nkubectl get pods -A &&\nkubectl get events -A\n```\n" + "Explanation. " * 50
+    result = await handler.understand_command("what is broken")
+    assert result["command"] == "kubectl get pods -A && kubectl get events -A"
+    assert bedrock.streamed < 40
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_are_bounded(handler, bedrock):
+    """No more than MAX_CONCURRENT_CALLS Bedrock calls run at once"""
+    handler.MAX_CONCURRENT_CALLS = 2
+    lock = threading.Lock()
+    active = []
+    peak = []
+    invoke_model = bedrock.invoke_model
+
+    def slow_invoke_model(**kwargs):
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(0.02)
+        with lock:
+            active.pop()
+        return invoke_model(**kwargs)
+
+    bedrock.invoke_model = slow_invoke_model
+    await asyncio.gather(*(handler._call_llm(f"prompt {i}") for i in range(6)))
+    assert max(peak) == 2
+
+
+def test_bedrock_client_is_shared(monkeypatch):
+    """Handlers in the same region share one pooled client"""
+    monkeypatch.setattr(llm_handler, "_BEDROCK_CLIENTS", {})
+    monkeypatch.setenv("AWS_REGION", "eu-west-1")
+    first, second = LLMHandler(), LLMHandler()
+    assert first.bedrock is second.bedrock
+    config = first.bedrock.meta.config
+    assert config.max_pool_connections == LLMHandler.MAX_CONCURRENT_CALLS
+    assert config.tcp_keepalive
+
+
+def test_request_body_reuses_encoded_prefix(handler):
+    """The static part of the body is encoded once and the result is valid JSON"""
+    body = json.loads(handler._request_body("list pods"))
+    assert body == {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": 1024,
+        "temperature": 0.1,
+        "messages": [{"role": "user", "content": "list pods"}]
+    }
+    handler._request_body("list services", system=handler.prompt_template)
+    prefix = handler._body_prefixes[handler.prompt_template]
+    assert handler._request_body("list nodes", system=handler.prompt_template).startswith(prefix)
+    assert handler._body_prefix(handler.prompt_template) is prefix
+
+
+@pytest.mark.asyncio
+async def test_summarize_output_skips_healthy_output(handler, bedrock):
+    """Output without issue keywords is not sent to the LLM"""
+    assert await handler.summarize_output("web-1   1/1   Running   0   3d") == "No issues found in the output."
+    assert bedrock.calls == []
+    await handler.summarize_output("web-1   0/1   Error   2   3d")
+    assert len(bedrock.calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_conversation_context_is_bounded(handler):
+    """Only the most recent messages are kept in the conversation context"""
+    for i in range(10):
+        await handler.understand_command(f"kubectl get pods -n ns{i}")
+    messages = handler.conversation_context.messages
+    assert len(messages) == LLMHandler.CONTEXT_MESSAGES
+    assert messages[-1]["content"] == "kubectl get pods -n ns9"
+    assert "user: kubectl get pods -n ns7" in handler._build_context("")
+    assert "ns6" not in handler._build_context("")
+
+
+def test_context_keeps_salient_output_lines(handler):
+    """Large outputs are cut to the header, issue lines and the most recent lines"""
+    lines = ["NAME   READY   STATUS"] + [f"web-{i}   1/1   Running" for i in range(200)]
+    lines[50] = "web-49   0/1   Pending"
+    handler.conversation_context.last_output = "\n".join(lines)
+    output = handler._top_k_lines(handler.conversation_context.last_output, 5)
+    assert output.splitlines() == [lines[0], lines[50], lines[-3], lines[-2], lines[-1]]
+
+    handler.conversation_context.last_output = "x" * 10000
+    assert handler._build_context("") == "Last command output: " + "x" * LLMHandler.CONTEXT_OUTPUT_CHARS
+
+
+@pytest.mark.asyncio
+async def test_identical_concurrent_requests_share_one_call(handler, bedrock):
+    """Concurrent identical summaries are served by a single Bedrock call"""
+    output = "web-1   0/1   Pending   0   1m"
+    invoke_model = bedrock.invoke_model
+
+    def slow_invoke_model(**kwargs):
+        time.sleep(0.05)
+        return invoke_model(**kwargs)
+
+    bedrock.invoke_model = slow_invoke_model
+    summaries = await asyncio.gather(*(handler.summarize_output(output) for _ in range(5)))
+    assert len(set(summaries)) == 1
+    assert len(bedrock.calls) == 1
+    assert handler._inflight == {}
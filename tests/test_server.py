@@ -1,6 +1,10 @@
+import asyncio
+import threading
+
 import pytest
 from fastapi.testclient import TestClient
-from src.server import app, Message
+from loguru import logger
+from src.server import app, Message, service_handlers, load_config, LOG_MESSAGE_CHARS
 
 client = TestClient(app)
 
@@ -49,3 +53,83 @@ def test_health_check():
     response = client.get("/health")
     assert response.status_code == 200
     assert response.json() == {"status": "running", "service": "kube-core-mcp"}
+
+def test_get_logs():
+    """Test that the most recent log records are returned oldest first"""
+    logger.info("first test record")
+    logger.warning("second test record\nspanning lines")
+    response = client.get("/api/logs", params={"limit": 2})
+    assert response.status_code == 200
+    logs = response.json()["logs"]
+    assert [entry["message"] for entry in logs] == ["first test record", "second test record\nspanning lines"]
+    assert logs[1]["level"] == "WARNING"
+
+def test_log_buffer_bounds_record_size():
+    """Test that debug records are not kept and long messages are cut"""
+    logger.debug("debug record")
+    logger.info("x" * (LOG_MESSAGE_CHARS * 2))
+    logs = client.get("/api/logs", params={"limit": 2}).json()["logs"]
+    assert "debug record" not in [entry["message"] for entry in logs]
+    assert logs[-1]["message"] == "x" * LOG_MESSAGE_CHARS
+
+async def _executor_thread_name():
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, lambda: threading.current_thread().name)
+
+def test_handlers_are_created_at_startup():
+    """Test that the service handlers are constructed when the app starts"""
+    with TestClient(app) as started:
+        assert set(service_handlers) == {"kubernetes", "llm"}
+        assert started.portal.call(_executor_thread_name).startswith("mcp")
+        assert started.get("/health").status_code == 200
+
+def test_load_config_is_cached(tmp_path, monkeypatch):
+    """Test that the config file is parsed once and reused"""
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text("host: 127.0.0.1\nport: 9000\nlog_level: DEBUG\n")
+    monkeypatch.setenv("CONFIG_PATH", str(config_file))
+    load_config.cache_clear()
+    try:
+        assert load_config() == {"host": "127.0.0.1", "port": 9000, "log_level": "DEBUG"}
+        config_file.unlink()
+        assert load_config()["port"] == 9000
+    finally:
+        load_config.cache_clear()
+
+def test_list_services_reports_each_handler(monkeypatch):
+    """Test that /services reports every handler, including ones that fail"""
+    class InfoHandler:
+        async def get_service_info(self):
+            return {"capabilities": ["pods"], "model": None}
+
+    class BrokenHandler:
+        async def get_service_info(self):
+            raise RuntimeError("API server unreachable")
+
+    monkeypatch.setitem(service_handlers, "kubernetes", InfoHandler())
+    monkeypatch.setitem(service_handlers, "llm", BrokenHandler())
+    response = client.get("/services")
+    assert response.status_code == 200
+    assert response.json() == {
+        "kubernetes": {"name": "kubernetes", "capabilities": ["pods"], "model": None},
+        "llm": {"error": "API server unreachable"}
+    }
+
+def test_natural_language_reports_truncated_output(monkeypatch):
+    """Test that /nl tells the caller when the command output was cut at the size cap"""
+    class LLM:
+        async def understand_command(self, message):
+            return {"success": True, "command": "kubectl logs web-1"}
+
+        async def summarize_output(self, output):
+            return "summary"
+
+    class Kubernetes:
+        async def execute_command(self, command):
+            return {"success": True, "raw_output": "line\n", "output": "line\n", "truncated": True, "analysis": {}}
+
+    monkeypatch.setitem(service_handlers, "llm", LLM())
+    monkeypatch.setitem(service_handlers, "kubernetes", Kubernetes())
+    response = client.post("/nl", json={"message": "show the web logs"})
+    assert response.status_code == 200
+    assert response.json()["truncated"] is True